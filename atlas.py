@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+# Builds the texture atlas that main.py loads at startup (see loadAtlas). Every
+#   texture gets packed into a 256x256 image per image map, laid out the same
+#   way Drawn would load them one by one, plus a manifest saying what is where.
+#   Run this again whenever a texture changes; the game will ignore an atlas
+#   that is older than its textures.
+#
+#   python3 atlas.py                  builds atlas/ from player/*.png
+#
+# Needs Pillow, but only to build the atlas. The game itself doesn't.
+
+import sys, os, glob, json, argparse
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import main
+
+# Where the textures come from. The invalid textures are what Drawn falls back
+#   to, so they go in too.
+TEXTURE_GLOBS = ["invalid16.png", "invalid8.png", "player/*.png"]
+
+# Image map and how many fit in one, per texture size. Has to match Drawn.
+BANKS = {16: 0, 8: 1}
+PER_COLUMN = {16: 16, 8: 32}
+
+# Where Drawn puts the index'th texture of a size
+def slotAt(size, index):
+    return int(index / PER_COLUMN[size]) * size, (index % PER_COLUMN[size]) * size
+
+def buildAtlas(outDir):
+    files = []
+    for pattern in TEXTURE_GLOBS:
+        files += sorted(glob.glob(pattern))
+
+    banks = {size: Image.new("RGB", (256, 256)) for size in BANKS}
+    counts = {size: 0 for size in BANKS}
+    textures = []
+    for filename in files:
+        image = Image.open(filename).convert("RGB")
+        size = image.width
+        if image.size != (size, size) or size not in BANKS:
+            print("Skipping {}, it isn't 8x8 or 16x16".format(filename))
+            continue
+        if counts[size] >= PER_COLUMN[size] ** 2:
+            print("Skipping {}, image map {} is full".format(filename, BANKS[size]))
+            continue
+        u, v = slotAt(size, counts[size])
+        banks[size].paste(image, (u, v))
+        counts[size] += 1
+        filename = filename.replace(os.sep, "/")
+        textures.append({"name": filename.rsplit(".", 1)[0], "file": filename, "size": size, "bank": BANKS[size], "u": u, "v": v})
+
+    os.makedirs(outDir, exist_ok=True)
+    bankFiles = {}
+    for size, image in banks.items():
+        name = "bank{}.png".format(BANKS[size])
+        image.save(os.path.join(outDir, name))
+        bankFiles[str(BANKS[size])] = name
+
+    # The manifest goes last, so it is never newer than a half built atlas
+    manifest = {"version": main.ATLAS_VERSION, "banks": bankFiles, "textures": textures}
+    with open(os.path.join(outDir, os.path.basename(main.ATLAS_MANIFEST)), "w") as f:
+        json.dump(manifest, f, indent=1)
+    print("Packed {} textures into {}".format(len(textures), outDir))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the texture atlas for smolgame")
+    parser.add_argument("--out", default=os.path.dirname(main.ATLAS_MANIFEST), help="directory to write the atlas to")
+    args = parser.parse_args()
+    if Image is None:
+        print("CRITICAL FAIL! Building the atlas needs Pillow (pip install pillow).")
+        sys.exit(1)
+    buildAtlas(args.out)
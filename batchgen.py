@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+
+# Generates lots of seeded levels at once, spread over a pool of processes,
+#   and checks each one over. Every level comes back as plain data (its tile
+#   grids, rooms and turrets) along with stats about it, and gets written out
+#   as one JSON line as soon as it is done, so a big batch can be watched,
+#   stopped or fed into something else while it is still going.
+#
+#   python3 batchgen.py 1000 --out levels.jsonl
+#   python3 batchgen.py 1000 --turrets 3 --patrols 2 --only-valid
+#   python3 batchgen.py 100 --first-seed 5000 --no-grids --out -
+#
+# Each level is built in a World of its own, so nothing here touches the
+#   game's state.
+#
+# A level is valid if every room and turret can be walked to along floors.
+#   Rooms the layout puts past GL_WIDTH x GL_HEIGHT can't be, so levels with
+#   those fail.
+
+import sys, os, time, json, zlib, base64, argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import main
+
+# Where the player would start: the middle of the first room worldgen places,
+#   which is always at room tile 1,1
+START = (1*main.ROOM_TILES + 7, 1*main.ROOM_TILES + 7)
+
+# Packs a grid of bytes for JSON
+def packGrid(data):
+    return base64.b64encode(zlib.compress(data)).decode()
+
+def unpackGrid(text):
+    return zlib.decompress(base64.b64decode(text))
+
+# Tiles the player can walk to from x,y, the same way canGo lets them: inside
+#   GL_WIDTH x GL_HEIGHT and off walls, which includes the empty space outside
+#   the rooms. With floorOnly, only floor tiles are walked, which is what the
+#   level looks like it means. Returns a flat GL_WIDTH x GL_HEIGHT grid,
+#   index x*GL_HEIGHT + y, that is REACHED wherever can be walked to.
+REACHED = 2
+def reachable(width, height, tiles, x, y, floorOnly=False):
+    blocked = (main.TILE_WALL, main.TILE_EMPTY) if floorOnly else (main.TILE_WALL,)
+    w = main.GL_WIDTH
+    h = main.GL_HEIGHT
+    # Blocked tiles get marked as already seen
+    seen = bytearray([1 if floorOnly else 0]) * (w * h)
+    for gX in range(0, min(width, w)):
+        for gY in range(0, min(height, h)):
+            seen[gX*h + gY] = 1 if tiles[gX*height + gY] in blocked else 0
+    if not (0 <= x < w and 0 <= y < h) or seen[x*h + y]:
+        return seen
+    start = x*h + y
+    seen[start] = REACHED
+    queue = [start]
+    for i in queue:
+        iY = i % h
+        for n in (i - h, i + h, i - 1 if iY > 0 else -1, i + 1 if iY < h - 1 else -1):
+            if 0 <= n < w * h and not seen[n]:
+                seen[n] = REACHED
+                queue.append(n)
+    return seen
+
+def isReached(seen, x, y):
+    return 0 <= x < main.GL_WIDTH and 0 <= y < main.GL_HEIGHT and seen[x*main.GL_HEIGHT + y] == REACHED
+
+# Works out the stats for a level: how much of it can be reached, whether
+#   every room can be (at all, and along floors only), and how much of the
+#   reachable floor is in arming range of a turret
+def levelStats(width, height, tiles, rooms, turrets):
+    floors = (main.TILE_FLOOR, main.TILE_FLOOR_BLIP)
+    floorArea = sum(1 for tile in tiles if tile in floors)
+    walked = reachable(width, height, tiles, START[0], START[1])
+    alongFloors = reachable(width, height, tiles, START[0], START[1], floorOnly=True)
+    reachedFloor = sum(1 for x in range(0, min(width, main.GL_WIDTH)) for y in range(0, min(height, main.GL_HEIGHT))
+        if tiles[x*height + y] in floors and walked[x*main.GL_HEIGHT + y] == REACHED)
+    roomCenters = [(x*main.ROOM_TILES + 7, y*main.ROOM_TILES + 7) for x, y, kind, contents in rooms if kind == "room"]
+    roomsReached = sum(1 for x, y in roomCenters if isReached(walked, x, y))
+    roomsAlongFloors = sum(1 for x, y in roomCenters if isReached(alongFloors, x, y))
+
+    # Reachable floor within arming range of a turret
+    covered = set()
+    r = int(main.ARM_RANGE_SQ ** 0.5)
+    for x, y, contents, dir in turrets:
+        for cX in range(x - r, x + r + 1):
+            for cY in range(y - r, y + r + 1):
+                if (cX - x)**2 + (cY - y)**2 < main.ARM_RANGE_SQ and isReached(walked, cX, cY) \
+                        and 0 <= cX < width and 0 <= cY < height and tiles[cX*height + cY] in floors:
+                    covered.add((cX, cY))
+    turretsReached = sum(1 for x, y, contents, dir in turrets if isReached(walked, x, y))
+    turretsAlongFloors = sum(1 for x, y, contents, dir in turrets if isReached(alongFloors, x, y))
+
+    return {
+        "rooms": len(roomCenters),
+        "hallways": len(rooms) - len(roomCenters),
+        "floorArea": floorArea,
+        "reachableFloor": reachedFloor,
+        "roomsReached": roomsReached,
+        "connected": roomsReached == len(roomCenters),
+        "floorConnected": roomsAlongFloors == len(roomCenters),
+        "turrets": len(turrets),
+        "turretsReached": turretsReached,
+        "turretsAlongFloors": turretsAlongFloors,
+        "turretCoverage": len(covered) / max(reachedFloor, 1),
+    }
+
+# Builds the level for seed and returns it as plain data. This is what runs in
+#   the pool.
+def generateLevel(seed, roomSetup, grids=True):
+    start = time.perf_counter()
+    world = main.World(headless=True)
+    layout = main.worldgen(world, list(roomSetup), seed=seed)
+    width, height, tiles, flips, phases = main.levelGrids(world)
+    rooms = [(x, y, "room" if type(roomobj) is main.Room else "hallway", roomobj.contents) for (x, y), roomobj in layout.items()]
+    turrets = [(e.x, e.y, 1 if type(e) is main.StationaryTurret else 2, e.dir) for e in world.entities]
+    level = {
+        "seed": seed,
+        "roomSetup": list(roomSetup),
+        "width": width,
+        "height": height,
+        "rooms": rooms,
+        "turrets": turrets,
+        "stats": levelStats(width, height, tiles, rooms, turrets),
+    }
+    if grids:
+        level["tiles"] = packGrid(tiles)
+        level["flips"] = packGrid(flips)
+        level["phases"] = packGrid(phases)
+    level["stats"]["seconds"] = time.perf_counter() - start
+    return level
+
+# A level passes if every room and every turret can be walked to along
+#   floors. "connected" isn't enough, canGo lets the player cross the empty
+#   space between rooms, so that only fails where a room is walled off.
+def isValid(level):
+    stats = level["stats"]
+    return stats["floorConnected"] and stats["turretsAlongFloors"] == stats["turrets"]
+
+# Generates a level per seed over `workers` processes, calling onLevel with
+#   each one as it finishes (so not in seed order). Only a few levels per
+#   worker are queued up at a time, so memory stays flat however many seeds
+#   there are.
+def generateBatch(seeds, roomSetup, onLevel, workers=None, grids=True):
+    workers = workers or os.cpu_count() or 1
+    seeds = iter(seeds)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        while True:
+            while len(pending) < workers * 4:
+                seed = next(seeds, None)
+                if seed is None:
+                    break
+                pending.add(pool.submit(generateLevel, seed, roomSetup, grids))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                onLevel(future.result())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates and checks seeded smolgame levels in parallel")
+    parser.add_argument("count", type=int, help="how many levels to generate")
+    parser.add_argument("--first-seed", type=int, default=0, help="seeds run from this up")
+    parser.add_argument("--rooms", type=int, default=12, help="rooms per level")
+    parser.add_argument("--turrets", type=int, default=0, help="rooms with a stationary turret")
+    parser.add_argument("--patrols", type=int, default=0, help="rooms with a turret that moves and chases players")
+    parser.add_argument("--workers", type=int, help="processes to use (default: one per core)")
+    parser.add_argument("--out", default="levels.jsonl", help="file to write levels to, - for stdout")
+    parser.add_argument("--only-valid", action="store_true", help="only write levels that pass isValid()")
+    parser.add_argument("--no-grids", action="store_true", help="leave the tile grids out, just write layouts and stats")
+    args = parser.parse_args()
+    if args.turrets + args.patrols > args.rooms:
+        parser.error("more turrets than rooms")
+    roomSetup = [1]*args.turrets + [2]*args.patrols + [0]*(args.rooms - args.turrets - args.patrols)
+
+    out = sys.stdout if args.out == "-" else open(args.out, "w")
+    counts = {"done": 0, "valid": 0}
+    started = time.perf_counter()
+    def onLevel(level):
+        counts["done"] += 1
+        valid = isValid(level)
+        if valid:
+            counts["valid"] += 1
+        if valid or not args.only_valid:
+            out.write(json.dumps(level) + "\n")
+            out.flush()
+    try:
+        generateBatch(range(args.first_seed, args.first_seed + args.count), roomSetup, onLevel, args.workers, not args.no_grids)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - started
+    print("{} levels ({} valid) in {:.2f}s, {:.1f} levels/s".format(counts["done"], counts["valid"], elapsed, counts["done"] / max(elapsed, 1e-9)), file=sys.stderr)
@@ -0,0 +1,505 @@
+#!/usr/bin/python3
+
+# Benchmarks for the game. These run without a window: pyxel gets swapped out
+#   for a stand-in that accepts every call and does nothing (apart from
+#   counting draw calls), so all that gets measured is our own code. Worlds are
+#   seeded, so two runs of the same commit see the same levels.
+#
+#   python3 bench.py                        runs everything
+#   python3 bench.py update draw            runs just those
+#   python3 bench.py --json new.json        also saves the results
+#   python3 bench.py --compare old.json     shows the change against old.json
+
+import sys, os, types, random, time, gc, tracemalloc, argparse, json, platform, subprocess, tempfile, shutil
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+# Calls into the stub pyxel, by function name
+pyxelCalls = {}
+
+# A do-nothing pyxel. Only has what main.py actually touches.
+class StubImage():
+    # Decodes the image with Pillow if it is there, so loads cost about what
+    #   they do in pyxel. Without it this only reads the file.
+    def load(self, x, y, filename):
+        pyxelCalls["load"] += 1
+        if PILImage is not None:
+            PILImage.open(filename).convert("RGB")
+        else:
+            with open(filename, "rb") as f:
+                f.read()
+
+    def get(self, x, y):
+        return 0
+
+    def set(self, x, y, data):
+        pass
+
+    def copy(self, x, y, img, u, v, w, h):
+        pyxelCalls["copy"] += 1
+
+class StubTilemap():
+    def __init__(self):
+        self.refimg = 0
+
+    def get(self, x, y):
+        return 0
+
+    def set(self, x, y, data):
+        pass
+
+class StubSound():
+    def set(self, **kwargs):
+        pass
+
+def counted(name):
+    pyxelCalls[name] = 0
+    def call(*args, **kwargs):
+        pyxelCalls[name] += 1
+    return call
+
+def stubPyxel():
+    stub = types.ModuleType("pyxel")
+    images = [StubImage() for x in range(0,3)]
+    tilemaps = [StubTilemap() for x in range(0,8)]
+    noop = lambda *args, **kwargs: None
+    stub.image = lambda img, system=False: images[img]
+    stub.tilemap = lambda tm: tilemaps[tm]
+    stub.sound = lambda snd, system=False: StubSound()
+    for name in ["init", "run", "quit", "cls", "text", "stop"]:
+        setattr(stub, name, noop)
+    for name in ["blt", "bltm", "rect", "play"]:
+        setattr(stub, name, counted(name))
+    pyxelCalls["copy"] = 0
+    pyxelCalls["load"] = 0
+    stub.btn = lambda key: False
+    for i, name in enumerate(["KEY_UP", "KEY_DOWN", "KEY_LEFT", "KEY_RIGHT", "KEY_Q", "KEY_SPACE"]):
+        setattr(stub, name, i)
+    sys.modules["pyxel"] = stub
+    return stub
+
+stubPyxel()
+import main
+# "Opens" the stub window, so textures get loaded the way they are in the game
+main.setupPyxel()
+
+# Runs fn n times and returns the seconds per call. The garbage collector is
+#   kept out of the way so it doesn't land in a random iteration.
+def timeCalls(fn, n):
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for i in range(n):
+            fn()
+        return (time.perf_counter() - start) / n
+    finally:
+        gc.enable()
+
+# Runs fn n times under tracemalloc. Returns the bytes still allocated per call
+#   afterwards, and the peak. This is a separate run from timeCalls, since
+#   tracemalloc slows everything down a lot.
+def allocCalls(fn, n):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        for i in range(n):
+            fn()
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return size / n, peak
+
+# Times fn and measures its memory, and returns it all as one result
+def measure(name, params, fn, n):
+    perCall = timeCalls(fn, n)
+    allocs, peak = allocCalls(fn, n)
+    return {"name": name, "params": params, "calls": n, "seconds": perCall, "allocBytes": allocs, "peakBytes": peak}
+
+# A random walk for the player, the same every run
+def wanderScript(ticks, seed):
+    rng = random.Random(seed)
+    script = []
+    while len(script) < ticks:
+        keys = (rng.choice(["up", "down", "left", "right"]),)
+        script += [keys] * rng.randrange(1, 8)
+    return script[:ticks]
+
+# Builds a seeded worldgen level with `turrets` extra turrets scattered over
+#   its floor, with the player stood on a floor tile and the camera on them
+def buildWorld(rooms, turrets, seed, arrayLevel=False):
+    world = main.resetWorld()
+    world.rng.seed(seed)
+    rng = world.rng
+    main.setup(world)
+    main.worldgen(world, [0]*rooms, arrayLevel=arrayLevel)
+    floors = [(s.x, s.y) for s in world.structures if s.allow]
+    if world.level is not None:
+        xs, ys = main.np.nonzero((world.level.tiles == main.TILE_FLOOR) | (world.level.tiles == main.TILE_FLOOR_BLIP))
+        floors += list(zip(xs.tolist(), ys.tolist()))
+    floors.sort()
+    player = world.entitiesOfType(main.Player)[0]
+    x, y = rng.choice(floors)
+    world.moveEntity(player, x, y)
+    world.windowOffsetX = int(main.WIDTH/2) - x
+    world.windowOffsetY = int(main.HEIGHT/2) - y
+    for i in range(turrets):
+        x, y = rng.choice(floors)
+        world.addEntity(main.StationaryTurret("turret", x, y, rng.choice("NSEW"), rng=rng))
+    world.input = main.ScriptedInput(wanderScript(10000, seed), loop=True)
+    main.bakeLevel(world)
+    return player
+
+# Measures the memory a freshly generated level holds on to
+def measureLevel(rooms, seed, arrayLevel, chunked=False):
+    world = main.resetWorld()
+    # Chunked levels get built around the player
+    world.addEntity(main.Player("player"))
+    world.rng.seed(seed)
+    gc.collect()
+    tracemalloc.start()
+    main.worldgen(world, [0]*rooms, arrayLevel=arrayLevel, chunked=chunked)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if world.level is not None:
+        tiles = int((world.level.tiles != main.TILE_EMPTY).sum())
+    else:
+        tiles = len(world.structures)
+    main.resetWorld()
+    return {"tiles": tiles, "bytes": size, "peak": peak}
+
+# Compares how much memory a full worldgen level takes as Wall/Floor objects
+#   against the same level as a NumPy TileLevel, and against a chunked level
+#   with only the chunks around the player built
+def benchMemory(args):
+    rooms = args.rooms[-1]
+    kinds = {"objects": {"arrayLevel": False}, "chunked": {"arrayLevel": False, "chunked": True}}
+    if main.np is not None:
+        kinds["array"] = {"arrayLevel": True}
+
+    # Run each once first so the template caches and numpy's own lazy setup
+    #   aren't counted against the level
+    for kind in kinds.values():
+        measureLevel(rooms, args.seed, **kind)
+
+    results = []
+    for name, kind in kinds.items():
+        r = measureLevel(rooms, args.seed, **kind)
+        perTile = r["bytes"] / max(r["tiles"], 1)
+        print("{:8} {:7} tiles {:10.1f} KiB held {:10.1f} KiB peak {:8.1f} B/tile".format(
+            name, r["tiles"], r["bytes"]/1024, r["peak"]/1024, perTile))
+        results.append({"name": "memory", "params": {"kind": name, "rooms": rooms},
+            "tiles": r["tiles"], "heldBytes": r["bytes"], "peakBytes": r["peak"]})
+    if "array" not in kinds:
+        print("numpy is not installed, skipped the array level")
+    return results
+
+# Generating whole levels, at each size, and chunked levels up to the first
+#   chunks being built
+def benchWorldgen(args):
+    results = []
+    for rooms in args.rooms:
+        for chunked in (False, True):
+            def gen():
+                world = main.resetWorld()
+                world.rng.seed(args.seed)
+                world.addEntity(main.Player("player"))
+                main.worldgen(world, [0]*rooms, chunked=chunked)
+            results.append(measure("worldgen", {"rooms": rooms, "chunked": chunked}, gen, 5))
+    return results
+
+# Seeded levels, generated from scratch and then loaded from the level cache
+def benchLevelCache(args):
+    results = []
+    cacheDir = tempfile.mkdtemp()
+    main.LEVEL_CACHE_DIR = cacheDir
+    try:
+        for rooms in args.rooms:
+            for cached in (False, True):
+                def gen():
+                    main.worldgen(main.resetWorld(), [0]*rooms, seed=args.seed, cache=cached)
+                gen()
+                results.append(measure("seededWorldgen", {"rooms": rooms, "cached": cached}, gen, 5))
+    finally:
+        shutil.rmtree(cacheDir)
+    return results
+
+# Startup, registering (and loading) every texture the game uses, one PNG at a
+#   time and then from a texture atlas. Building the atlas needs Pillow, so
+#   without it only the first gets measured.
+def benchStartup(args):
+    def start(manifest=None):
+        world = main.resetWorld()
+        main.resetTextures()
+        if manifest is not None:
+            main.loadAtlas(manifest)
+        main.setup(world)
+        main.basicWorldgen(world)
+    kinds = {"pngs": None}
+    atlasDir = tempfile.mkdtemp()
+    try:
+        import atlas
+        if atlas.Image is not None:
+            atlas.buildAtlas(atlasDir)
+            kinds["atlas"] = os.path.join(atlasDir, os.path.basename(main.ATLAS_MANIFEST))
+        else:
+            print("Pillow is not installed, skipped the atlas")
+        results = []
+        for name, manifest in kinds.items():
+            pyxelCalls["load"] = 0
+            start(manifest)
+            loads = pyxelCalls["load"]
+            r = measure("startup", {"textures": name}, lambda: start(manifest), 20)
+            r["loads"] = loads
+            print("{:8} {} image loads".format(name, loads))
+            results.append(r)
+    finally:
+        shutil.rmtree(atlasDir)
+    return results
+
+# Room templates, read cold from disk and then from the cache
+def benchCSV(args):
+    def cold():
+        main.roomTemplates.clear()
+        main.roomVariants.clear()
+        main.parseRoomCSV("room.csv", True, False, True, False)
+    def warm():
+        main.parseRoomCSV("room.csv", True, False, True, False)
+    return [measure("parseRoomCSV", {"cache": "cold"}, cold, 50),
+        measure("parseRoomCSV", {"cache": "warm"}, warm, 10000)]
+
+# Collision checks at random spots in the level, at each size
+def benchCanGo(args):
+    results = []
+    for rooms in args.rooms:
+        buildWorld(rooms, 0, args.seed)
+        rng = random.Random(args.seed)
+        moves = [(rng.randrange(0, main.GL_WIDTH), rng.randrange(0, main.GL_HEIGHT), rng.choice([-1,0,1]), rng.choice([-1,0,1])) for i in range(1000)]
+        pos = [0]
+        def check():
+            x, y, a, b = moves[pos[0] % len(moves)]
+            pos[0] += 1
+            main.world.canGo(x, y, a, b)
+        results.append(measure("canGo", {"rooms": rooms, "structures": len(main.world.structures)}, check, 20000))
+    return results
+
+# Game ticks, at each size and turret count
+def benchUpdate(args):
+    results = []
+    for rooms in args.rooms:
+        for turrets in args.turrets:
+            buildWorld(rooms, turrets, args.seed)
+            results.append(measure("update", {"rooms": rooms, "turrets": turrets, "structures": len(main.world.structures)}, main.update, args.ticks))
+    return results
+
+# Game ticks with chasing turrets, at each turret count, and how long building
+#   the flow field they all follow takes
+def benchChase(args):
+    results = []
+    rooms = args.rooms[-1]
+    for chasers in args.turrets:
+        buildWorld(rooms, 0, args.seed)
+        world = main.world
+        floors = sorted((s.x, s.y) for s in world.structures if s.allow)
+        for i in range(chasers):
+            x, y = world.rng.choice(floors)
+            world.addEntity(main.MovingTurret("turret", x, y, world.rng.choice("NSEW"), chase=True, rng=world.rng))
+        results.append(measure("chase", {"rooms": rooms, "chasers": chasers}, main.update, args.ticks))
+    flow = main.world.flow
+    players = tuple((int(p.x), int(p.y)) for p in main.world.entitiesOfType(main.Player))
+    results.append(measure("flowField", {"rooms": rooms, "radius": flow.radius}, lambda: flow.build(players), 200))
+    return results
+
+# Frames, at each size and turret count, with and without the view cache.
+#   Also counts the blt/bltm/copy calls made per frame. "scroll" frames tick
+#   the game in between, so the camera follows the player around.
+def benchDraw(args):
+    results = []
+    for rooms in args.rooms:
+        for turrets in args.turrets:
+            for cache in (True, False):
+                for scroll in (False, True):
+                    main.useViewCache = cache
+                    buildWorld(rooms, turrets, args.seed)
+                    main.update()
+                    main.draw()
+                    for name in pyxelCalls:
+                        pyxelCalls[name] = 0
+                    if scroll:
+                        def frame():
+                            main.update()
+                            main.draw()
+                    else:
+                        frame = main.draw
+                    r = measure("draw", {"rooms": rooms, "turrets": turrets, "structures": len(main.world.structures),
+                        "cache": cache, "scroll": scroll}, frame, args.ticks)
+                    frames = r["calls"] * 2 # measure runs it twice
+                    for name, count in pyxelCalls.items():
+                        r[name + "PerFrame"] = count / frames
+                    results.append(r)
+    main.useViewCache = True
+    return results
+
+# Field of view from the player: worked out from scratch, then straight out of
+#   the cache, and then frames drawn with fog of war on
+def benchSight(args):
+    results = []
+    rooms = args.rooms[-1]
+    buildWorld(rooms, 0, args.seed)
+    world = main.world
+    player = world.entitiesOfType(main.Player)[0]
+    for radius in (main.TURRET_SIGHT, main.PLAYER_SIGHT):
+        def cast():
+            world.sight.clear()
+            world.sight.visibleFrom(player.x, player.y, radius)
+        results.append(measure("sight", {"radius": radius, "cached": False}, cast, 1000))
+        results.append(measure("sight", {"radius": radius, "cached": True},
+            lambda: world.sight.visibleFrom(player.x, player.y, radius), 20000))
+    for fog in (False, True):
+        main.useFog = fog
+        main.draw()
+        for name in pyxelCalls:
+            pyxelCalls[name] = 0
+        r = measure("draw", {"rooms": rooms, "fog": fog}, main.draw, args.ticks)
+        for name, count in pyxelCalls.items():
+            r[name + "PerFrame"] = count / (r["calls"] * 2)
+        results.append(r)
+    main.useFog = False
+    return results
+
+# Ticks with turrets crowded round the player, all buzzing, playing sounds
+#   straight through to pyxel and through the queue. Also counts how many
+#   sounds actually get started per tick.
+def benchAudio(args):
+    results = []
+    for direct in (False, True):
+        player = buildWorld(args.rooms[-1], 0, args.seed)
+        if direct:
+            main.world.audio = main.PyxelAudio()
+        for i in range(args.turrets[-1]):
+            main.world.addEntity(main.StationaryTurret("turret", player.x, player.y, "NSEW"[i % 4]))
+        main.world.input = main.NullInput()
+        main.update()
+        pyxelCalls["play"] = 0
+        r = measure("audio", {"turrets": args.turrets[-1], "queued": not direct}, main.update, args.ticks)
+        r["playPerTick"] = pyxelCalls["play"] / (r["calls"] * 2)
+        results.append(r)
+    return results
+
+# Firing a turret, along each direction
+def benchLazer(args):
+    buildWorld(args.rooms[-1], 0, args.seed)
+    player = main.world.entitiesOfType(main.Player)[0]
+    results = []
+    for dir in "NSEW":
+        turret = main.StationaryTurret("turret", player.x, player.y, dir)
+        def fire():
+            main.world.lazers.clear()
+            turret.placeLazer(main.world, dir)
+        results.append(measure("placeLazer", {"dir": dir}, fire, 5000))
+    return results
+
+# Several headless simulations, each with its own World, ticked side by side
+#   in one process. The time is per round of one tick in every world.
+def benchWorlds(args):
+    results = []
+    for count in (1, 4, 16):
+        sims = [main.Simulation(seed=args.seed + i, inputs=main.ScriptedInput(wanderScript(10000, args.seed + i), loop=True))
+            for i in range(count)]
+        def tick():
+            for sim in sims:
+                sim.step()
+        results.append(measure("worlds", {"worlds": count}, tick, args.ticks))
+    return results
+
+BENCHMARKS = {
+    "memory": benchMemory,
+    "worldgen": benchWorldgen,
+    "levelcache": benchLevelCache,
+    "startup": benchStartup,
+    "csv": benchCSV,
+    "cango": benchCanGo,
+    "update": benchUpdate,
+    "chase": benchChase,
+    "draw": benchDraw,
+    "lazer": benchLazer,
+    "sight": benchSight,
+    "audio": benchAudio,
+    "worlds": benchWorlds,
+}
+
+def describeParams(r):
+    return " ".join("{}={}".format(k, v) for k, v in r["params"].items())
+
+# One line per result for the terminal
+def describe(r):
+    line = "{:12} {:40} {:12.2f} us/call {:10.0f} B/call {:10.1f} KiB peak".format(
+        r["name"], describeParams(r), r["seconds"]*1e6, r["allocBytes"], r["peakBytes"]/1024)
+    for key in ["bltPerFrame", "bltmPerFrame", "copyPerFrame", "rectPerFrame", "playPerTick"]:
+        if key in r:
+            line += " {:6.1f} {}".format(r[key], key)
+    return line
+
+def resultKey(r):
+    return (r["name"], json.dumps(r["params"], sort_keys=True))
+
+# Prints how each timed result changed against the same one in a saved run
+def compare(results, baseline):
+    old = {resultKey(r): r for r in baseline["results"]}
+    print("== compared to {} ==".format(baseline["meta"].get("commit") or "baseline"))
+    for r in results:
+        was = old.get(resultKey(r))
+        if was is None or "seconds" not in r or "seconds" not in was:
+            continue
+        change = (r["seconds"] - was["seconds"]) / was["seconds"] * 100
+        print("{:12} {:40} {:10.2f} -> {:10.2f} us {:+7.1f}%".format(r["name"], describeParams(r),
+            was["seconds"]*1e6, r["seconds"]*1e6, change))
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def intList(text):
+    return [int(x) for x in text.split(",")]
+
+def runBenchmarks():
+    parser = argparse.ArgumentParser(description="Benchmarks for smolgame")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, out of: {} (default: all)".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--rooms", type=intList, default=[4, 12, 24], help="comma separated room counts to pass to worldgen")
+    parser.add_argument("--turrets", type=intList, default=[0, 20, 100], help="comma separated extra turret counts")
+    parser.add_argument("--ticks", type=int, default=200, help="ticks/frames per update and draw measurement")
+    parser.add_argument("--seed", type=int, default=1, help="seed for random")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--compare", help="compare against results saved with --json")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {}".format(name))
+
+    results = []
+    for name in args.names or list(BENCHMARKS):
+        print("== {} ==".format(name))
+        for r in BENCHMARKS[name](args):
+            if "seconds" in r:
+                print(describe(r))
+            results.append(r)
+
+    out = {
+        "meta": {"commit": gitCommit(), "python": platform.python_version(), "seed": args.seed,
+            "numpy": main.np is not None, "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(out, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    runBenchmarks()
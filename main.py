@@ -3,10 +3,24 @@
 # Created by Jared Dunbar, April 4th, 2020
 # Use this as an example for a basic game.
 
-import pyxel, random, math
-import os.path
+import random, math, time, json, atexit, struct, mmap, zlib, collections
+import os, os.path
 from os import path
 
+# pyxel is only needed to actually show the game. Headless simulations (see
+#   Simulation) run fine without it.
+try:
+    import pyxel
+except ImportError:
+    pyxel = None
+
+# numpy is optional. Without it everything still works, you just can't use
+#   the array-backed TileLevel.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Width and height of game screen, in tiles
 WIDTH = 16
 HEIGHT = 12
@@ -15,20 +29,20 @@ HEIGHT = 12
 GL_WIDTH = 170
 GL_HEIGHT = 150
 
-# Window offsets for the panning feature.
-windowOffsetX = 0
-windowOffsetY = 0
+# Ticks (and frames) per second
+FPS = 20
 
-# Entities (should not) be able to walk through structures,
-#   unless they have "allow" set to True
-structures = []
+# Set once setupPyxel() has opened the window. Until then textures are still
+#   handed out handles so entities work the same, but nothing gets loaded.
+windowOpen = False
 
-# Entities can move all over the place and stand in the same cube, but not walk
-#   into structures unless the structure has "allow" set to True
-entities = []
+# Entities are bucketed by which ENTITY_CELL x ENTITY_CELL block of tiles they
+#   are in, see World
+ENTITY_CELL = 4
 
-# These contain all fireables and are cleared relatively often.
-lazers = []
+# Everything in the game world (structures, entities, the level, the camera
+#   and the clock) lives in a World, see further down. Textures and sounds are
+#   shared by every world.
 
 # Sound mappings
 sounds = {}
@@ -37,6 +51,15 @@ sounds = {}
 texture8 = {}
 texture16 = {}
 
+# Every registered texture, indexed by its handle. Handles are plain ints
+#   handed out by registerTexture(), so drawing never has to look a texture up
+#   by name.
+textures = []
+
+# Flip bits, as taken by drawTexture()
+FLIP_X = 1
+FLIP_Y = 2
+
 # Information about the image map:
 
 # Image maps are 256x256. This allows for 256 16x16 textures in one tilemap,
@@ -44,13 +67,15 @@ texture16 = {}
 
 # Image Map 0: 16x16 textures
 # Image Map 1: 8x8 textures
-# Image Map 2: <unused>
+# Image Map 2: baked level tiles, see bakeLevel()
 
 # This sets up all the rendering code for ya. Give it a image,
 #   and it will remember the thing for you.
 #   NOTE: transparent is a color key. If -1, doesn't do transparent stuff.
+#   inAtlas says the texture is already in its image map (see loadAtlas), so
+#   it just gets registered, not loaded.
 class Drawn():
-    def __init__(self, name, size=16, texture="invalid16.png", transparent=-1):
+    def __init__(self, name, size=16, texture="invalid16.png", transparent=-1, inAtlas=False):
         if (size != 8) and (size != 16):
             print("CRITICAL FAIL! Texture is not of correct size!")
             exit(1)
@@ -58,230 +83,663 @@ class Drawn():
         if size == 16:
             # Only register if we're not in the 16x16 texturemap
             if name not in texture16:
-                if not path.exists(texture):
+                if not inAtlas and not path.exists(texture):
                     texture = "invalid16.png"
                 # 16x16 is in bank 0
                 self.bank = 0
                 self.xLoc = int(len(texture16)/16)*16
                 self.yLoc = (len(texture16)%16) * 16
-                pyxel.image(self.bank).load(self.xLoc, self.yLoc, texture)
+                if windowOpen and not inAtlas:
+                    pyxel.image(self.bank).load(self.xLoc, self.yLoc, texture)
                 texture16[name] = self
+                self.intern(16)
         elif size == 8:
             # Only register if we're not in the 8x8 texturemap
             if name not in texture8:
-                if not path.exists(texture):
+                if not inAtlas and not path.exists(texture):
                     print("Could not find texture {}".format(texture))
                     texture = "invalid8.png"
                 # 8x8 is in bank 1
                 self.bank = 1
                 self.xLoc = int(len(texture8)/32)*8
                 self.yLoc = (len(texture8)%32)*8
-                pyxel.image(self.bank).load(self.xLoc, self.yLoc, texture)
+                if windowOpen and not inAtlas:
+                    pyxel.image(self.bank).load(self.xLoc, self.yLoc, texture)
                 texture8[name] = self
+                self.intern(8)
+
+    # Hands out a handle and works out the blt arguments for all four flips
+    #   up front, indexed by the FLIP_* bits
+    def intern(self, ts):
+        self.ts = ts
+        self.handle = len(textures)
+        self.blits = tuple((self.bank, self.xLoc, self.yLoc, -ts if f & FLIP_X else ts, -ts if f & FLIP_Y else ts) for f in range(0,4))
+        textures.append(self)
 
     def draw(self, x, y, trans=None, fX=False, fY=False):
-        if (trans == None):
-            trans = self.trans
-        # Default texture size is 16x16
-        ts = 16
-        # If we're in Bank 1, texture size is 8x8
-        if self.bank == 1:
-            ts = 8
-        xf = ts
-        yf = ts
+        flip = 0
         if fX:
-            xf = -ts
+            flip |= FLIP_X
         if fY:
-            yf = -ts
-        pyxel.blt(x*abs(ts), y*abs(ts), self.bank, self.xLoc, self.yLoc, xf, yf, trans)
+            flip |= FLIP_Y
+        drawTexture(self.handle, x, y, trans, flip)
+
+# Registers a texture if it hasn't been already, and returns its handle
+def registerTexture(name, size=16, texture="invalid16.png", transparent=-1):
+    known = texture16
+    if size == 8:
+        known = texture8
+    if name not in known:
+        Drawn(name, size, texture, transparent)
+    return known[name].handle
+
+# A texture atlas built by atlas.py: image maps 0 and 1 saved whole with every
+#   texture already in them, and a manifest of what is where. Loading it is
+#   one image load per map instead of one per texture.
+ATLAS_MANIFEST = "atlas/atlas.json"
+ATLAS_VERSION = 1
+
+# Loads the atlas and registers everything in it. Returns False (and nothing
+#   gets loaded) if there is no atlas, or if it is older than any of the
+#   textures in it, in which case textures get loaded one by one as usual.
+def loadAtlas(manifestFile=ATLAS_MANIFEST):
+    try:
+        f = open(manifestFile)
+    except OSError:
+        return False
+    manifest = json.load(f)
+    f.close()
+    if manifest.get("version") != ATLAS_VERSION:
+        print("Texture atlas {} is from another version, run atlas.py again".format(manifestFile))
+        return False
+    built = os.path.getmtime(manifestFile)
+    for entry in manifest["textures"]:
+        if path.exists(entry["file"]) and os.path.getmtime(entry["file"]) > built:
+            print("Texture atlas {} is older than {}, run atlas.py again".format(manifestFile, entry["file"]))
+            return False
 
+    # The atlas lays textures out the same way Drawn does, so registering them
+    #   in order puts each one where the atlas has it. That only works if
+    #   nothing else got registered first.
+    if texture16 or texture8:
+        print("Texture atlas {} has to be loaded before any other textures, not using it".format(manifestFile))
+        return False
+    if windowOpen:
+        atlasDir = os.path.dirname(manifestFile)
+        for bank, image in manifest["banks"].items():
+            pyxel.image(int(bank)).load(0, 0, os.path.join(atlasDir, image))
+    for entry in manifest["textures"]:
+        Drawn(entry["name"], entry["size"], entry["file"], inAtlas=True)
+    return True
+
+# Throws away every registered texture, so they get registered (and loaded)
+#   from scratch again
+def resetTextures():
+    global chargeTex, beamTexH, beamTexV
+    texture8.clear()
+    texture16.clear()
+    textures.clear()
+    textureHandles.clear()
+    bakeSlots.clear()
+    chargeTex = ()
+    beamTexH = ()
+    beamTexV = ()
+
+# Draws the texture with handle h at x,y, which are in units of the texture's
+#   own size. flip is made of FLIP_* bits.
+def drawTexture(h, x, y, trans=None, flip=0):
+    tex = textures[h]
+    bank, u, v, w, hgt = tex.blits[flip]
+    if (trans == None):
+        trans = tex.trans
+    pyxel.blt(x*tex.ts, y*tex.ts, bank, u, v, w, hgt, trans)
+    if profiler.enabled:
+        profiler.count("blt")
+
+# Audio backends. Every World plays its sounds (see Sounded) through one of
+#   these, its audio, so game logic can play sounds without caring whether
+#   there is anything to hear them. The shown world goes through a QueuedAudio
+#   in front of pyxel, headless ones through a NullAudio of their own.
+class PyxelAudio():
+    def play(self, stream, sound):
+        pyxel.play(stream, sound.id)
+
+    def flush(self):
+        pass
+
+# Swallows everything, for headless runs. Still counts what got played.
+class NullAudio():
+    def __init__(self):
+        self.played = 0
+
+    def play(self, stream, sound):
+        self.played += 1
+
+    def flush(self):
+        pass
+
+# Queues up what game logic plays and hands it to another backend once per
+#   tick, in flush(). Per stream only the highest priority sound posted that
+#   tick gets through (the first one on a tie), and it doesn't get through at
+#   all if the same sound is still playing on that stream, or something of
+#   higher priority is. So a turret buzzing every tick or the player walking
+#   into a wall over and over plays the sound once, all the way through,
+#   instead of restarting it every tick.
+class QueuedAudio():
+    def __init__(self, backend):
+        self.backend = backend
+        # Sound waiting to be played, by stream
+        self.pending = {}
+        # (sound, tick it ends on) of what was last played, by stream
+        self.playing = {}
+        self.tick = 0
+
+    def play(self, stream, sound):
+        waiting = self.pending.get(stream)
+        if waiting is None or sound.priority > waiting.priority:
+            self.pending[stream] = sound
+        if profiler.enabled:
+            profiler.count("soundsPosted")
+
+    def flush(self):
+        self.tick += 1
+        for stream, sound in self.pending.items():
+            playing = self.playing.get(stream)
+            if playing is not None and self.tick < playing[1]:
+                if playing[0] is sound or playing[0].priority > sound.priority:
+                    continue
+            self.backend.play(stream, sound)
+            self.playing[stream] = (sound, self.tick + sound.ticks)
+            if profiler.enabled:
+                profiler.count("soundsPlayed")
+        self.pending.clear()
+
+# A sound. Higher priority sounds win out over lower ones on the same stream,
+#   see QueuedAudio. Sounds are shared by every world, and each world plays
+#   them through its own audio.
 class Sounded():
-    def __init__(self, name, notes, tone="s", volume="4", effect=("n" * 4 + "f"), speed=7):
+    def __init__(self, name, notes, tone="s", volume="4", effect=("n" * 4 + "f"), speed=7, priority=0):
         if name not in sounds:
             self.id = len(sounds)
-            pyxel.sound(self.id).set(note=notes, tone=tone, volume=volume, effect=effect, speed=speed)
+            self.notes = notes
+            self.tone = tone
+            self.volume = volume
+            self.effect = effect
+            self.speed = speed
+            self.priority = priority
+            # How many ticks it lasts. Every note (or rest) starts with a
+            #   letter, and lasts speed/120s.
+            count = sum(1 for c in notes.lower() if c in "abcdefgr")
+            self.ticks = max(1, math.ceil(count * speed * FPS / 120))
             sounds[name] = self
+            if windowOpen:
+                self.load()
+
+    # Hands the sound over to pyxel
+    def load(self):
+        pyxel.sound(self.id).set(note=self.notes, tone=self.tone, volume=self.volume, effect=self.effect, speed=self.speed)
 
-    # There are 4 streams - 0 through 3
-    def play(self, stream=0):
-        pyxel.play(stream, self.id)
+    # Plays the sound in world. There are 4 streams - 0 through 3
+    def play(self, world, stream=0):
+        world.audio.play(stream, self)
+
+# Input sources. The game only ever asks its world's input whether one
+#   of these keys is held, so it can be driven by pyxel, a script, or nothing.
+KEYS = ("up", "down", "left", "right", "quit", "space", "profile")
+
+# Nothing is ever held. advance() is called once at the start of every tick,
+#   and ticked() once at the end of it, with the world being ticked.
+class NullInput():
+    def advance(self, world):
+        pass
+
+    def ticked(self, world):
+        pass
+
+    def btn(self, key):
+        return False
+
+# Reads the real keyboard through pyxel
+class PyxelInput(NullInput):
+    def __init__(self):
+        self.keys = {}
+
+    def btn(self, key):
+        if not self.keys:
+            self.keys = {"up": pyxel.KEY_UP, "down": pyxel.KEY_DOWN, "left": pyxel.KEY_LEFT,
+                "right": pyxel.KEY_RIGHT, "quit": pyxel.KEY_Q, "space": pyxel.KEY_SPACE,
+                "profile": pyxel.KEY_F1}
+        return pyxel.btn(self.keys[key])
+
+# Plays back a script: a list holding the keys held down on each tick. Once the
+#   script runs out nothing is held, unless loop is set.
+class ScriptedInput(NullInput):
+    def __init__(self, script, loop=False):
+        self.script = script
+        self.loop = loop
+        self.pos = -1
+        self.held = ()
+
+    def advance(self, world):
+        self.pos += 1
+        if self.loop and self.script:
+            self.pos %= len(self.script)
+        if self.pos < len(self.script):
+            self.held = self.script[self.pos]
+        else:
+            self.held = ()
+
+    def btn(self, key):
+        return key in self.held
+
+# Recordings of a game: the seed it started from, which world it was, the keys
+#   held on every tick (a bit per KEYS entry) and a hash of the world's state
+#   after every tick (see World.stateHash). The header is followed by the keys
+#   and then the hashes, zlib compressed together.
+REPLAY_MAGIC = b"SMRP"
+REPLAY_VERSION = 1
+# magic, version, seed, ticks, world name (see WORLD_FNS)
+REPLAY_HEADER = struct.Struct("<4sHqI16s")
+
+def keyMask(btn):
+    return sum(1 << i for i, key in enumerate(KEYS) if btn(key))
+
+def maskKeys(mask):
+    return tuple(key for i, key in enumerate(KEYS) if mask & (1 << i))
+
+# Passes another input through, writing down what it held each tick and how
+#   the world came out of it. save() writes the recording.
+class RecordingInput(NullInput):
+    def __init__(self, source, seed, worldName):
+        self.source = source
+        self.seed = seed
+        self.worldName = worldName
+        self.masks = bytearray()
+        self.hashes = []
+
+    def advance(self, world):
+        self.source.advance(world)
+        self.masks.append(keyMask(self.source.btn))
+
+    def btn(self, key):
+        return self.source.btn(key)
+
+    def ticked(self, world):
+        self.hashes.append(world.stateHash())
+
+    def save(self, filename):
+        body = bytes(self.masks) + struct.pack("<{}I".format(len(self.hashes)), *self.hashes)
+        f = open(filename, "wb")
+        f.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.seed, len(self.masks), self.worldName.encode()))
+        f.write(zlib.compress(body, 9))
+        f.close()
+
+# Plays a recording back, checking the world comes out of every tick the same
+#   as it did when recorded. The first tick it doesn't is kept in diverged.
+#   Once the recording runs out it holds "quit".
+class ReplayInput(NullInput):
+    def __init__(self, seed, worldName, masks, hashes):
+        self.seed = seed
+        self.worldName = worldName
+        self.masks = masks
+        self.hashes = hashes
+        self.pos = -1
+        self.held = ()
+        self.checked = 0
+        self.diverged = None
+
+    def advance(self, world):
+        self.pos += 1
+        if self.pos < len(self.masks):
+            self.held = maskKeys(self.masks[self.pos])
+        else:
+            self.held = ("quit",)
+
+    def btn(self, key):
+        return key in self.held
+
+    def ticked(self, world):
+        if self.pos < len(self.hashes):
+            self.checked += 1
+            if self.diverged is None and world.stateHash() != self.hashes[self.pos]:
+                self.diverged = world.tick
+
+# Reads a recording saved by RecordingInput.save(). Returns a ReplayInput for
+#   it, or None if the file isn't a usable recording.
+def loadReplay(filename):
+    try:
+        f = open(filename, "rb")
+        data = f.read()
+        f.close()
+    except OSError:
+        return None
+    if len(data) < REPLAY_HEADER.size:
+        return None
+    magic, version, seed, ticks, worldName = REPLAY_HEADER.unpack_from(data, 0)
+    if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+        return None
+    try:
+        body = zlib.decompress(data[REPLAY_HEADER.size:])
+    except zlib.error:
+        return None
+    if len(body) != ticks * 5:
+        return None
+    hashes = struct.unpack_from("<{}I".format(ticks), body, ticks)
+    return ReplayInput(seed, worldName.rstrip(b"\0").decode(), body[:ticks], hashes)
+
+# Texture handles keyed by the tuple of texture files they came from. Every
+#   entity using the same textures shares the one tuple instead of building
+#   its own list.
+textureHandles = {}
 
 # This is the base class of any thing that renders to the screen and ticks.
+#   It has __slots__ so that walls and floors, which there are tens of
+#   thousands of, don't each carry a __dict__. Subclasses that don't declare
+#   __slots__ (the player, turrets) still get one as usual.
 class Entity():
+    __slots__ = ("name", "x", "y", "allow", "baked", "frameNum", "dir", "tex")
+
+    # Set on structures that look the same every frame. These get baked into
+    #   a tilemap by bakeLevel() instead of being drawn one by one.
+    bakeable = False
+
+    # Set on anything that does something in update(). Only these get handed
+    #   to the world's Scheduler, the rest never get ticked at all.
+    tickable = False
+
     def __init__(self, name, texture=["invalid16.png"], x=0, y=0):
         self.name = name
         self.x = x
         self.y = y
         self.allow = False
+        self.baked = False
         self.frameNum = 0
         self.dir = "N"
-        self.texName = [x.rsplit(".",1)[0] for x in texture]
-        for tex in texture:
-            texName = tex.rsplit(".",1)[0] # remove file extension
-            Drawn(texName, 16, tex)
-
-    def update(self):
+        key = texture if type(texture) is tuple else tuple(texture)
+        handles = textureHandles.get(key)
+        if handles is None:
+            # remove file extension for the name
+            handles = tuple(registerTexture(tex.rsplit(".",1)[0], 16, tex) for tex in texture)
+            textureHandles[key] = handles
+        self.tex = handles
+
+    # Both get handed the World the entity is in
+    def update(self, world):
         pass
 
-    def draw(self):
-        drawX = self.x + windowOffsetX
-        drawY = self.y + windowOffsetY
+    def draw(self, world):
+        drawX = self.x + world.windowOffsetX
+        drawY = self.y + world.windowOffsetY
         if (drawX >= 0 and drawX < WIDTH) and (drawY >=0 and drawY < HEIGHT):
-            texture16[self.texName[self.frameNum]].draw(drawX, drawY)
-
-class Lazer():
-    def __init__(self, owner, x, y, dir):
+            drawTexture(self.tex[self.frameNum], drawX, drawY)
+
+# Handles for the turret charge meter and the beams. Every turret and Lazer
+#   shares these, they get filled in by registerTurretTextures().
+chargeTex = ()
+beamTexH = ()
+beamTexV = ()
+
+def registerTurretTextures():
+    global chargeTex, beamTexH, beamTexV
+    if chargeTex:
+        return
+    chargeTex = tuple(registerTexture("player/turret_charge_{}".format(x), 8, "player/turret_charge_{}.png".format(x)) for x in range(0,4))
+    beamTexH = tuple(registerTexture("player/beem_H{}".format(x), 8, "player/beem_H{}.png".format(x)) for x in range(0,3))
+    beamTexV = tuple(registerTexture("player/beem_V{}".format(x), 8, "player/beem_V{}.png".format(x)) for x in range(0,3))
+
+# Which way one step in each direction goes. Note that E is to the left and W
+#   is to the right, same as the player's controls.
+DIR_STEP = {"N": (0, -1), "S": (0, 1), "E": (-1, 0), "W": (1, 0)}
+STEP_DIR = {step: dir for dir, step in DIR_STEP.items()}
+
+# Beams flicker between their textures as they are drawn. That has its own
+#   RNG, so how often the screen gets drawn can't change what the game's
+#   random does, and replays stay in step.
+flickerRng = random.Random()
+
+# A turret's shot: one straight beam of half-tile segments running from
+#   the turret in one direction. It stops short of the first wall in its way.
+#   Segment i sits i/2 tiles out from the turret.
+class Beam():
+    def __init__(self, world, owner, x, y, dir):
         self.owner = owner
         self.x = x
         self.y = y
         self.dir = dir
-
-    def draw(self):
-        drawX = (self.x + windowOffsetX)*2
-        drawY = (self.y + windowOffsetY)*2
-        if (drawX >= 0 and drawX < WIDTH*2) and (drawY >=0 and drawY < HEIGHT*2):
-            if (self.dir == "N" or self.dir == "S"):
-                texture8["player/beem_V{}".format(random.randrange(0,3))].draw(drawX + 0.5, drawY + 0.5, 0)
-            else:
-                texture8["player/beem_H{}".format(random.randrange(0,3))].draw(drawX + 0.5, drawY + 0.5, 0)
-
+        self.dx, self.dy = DIR_STEP[dir]
+        maxSegments = WIDTH*4
+        if self.dx == 0:
+            maxSegments = HEIGHT*4
+        self.segments = maxSegments
+
+        # Walk out along the grid. A wall t tiles out cuts the beam off at
+        #   the last segment that doesn't overlap it.
+        t = 1
+        while t*2 - 1 < maxSegments:
+            if world.allowAt(x + self.dx*t, y + self.dy*t) == False:
+                self.segments = t*2 - 1
+                break
+            t += 1
+
+    # Does the beam pass over tile x,y?
+    def hits(self, x, y):
+        if self.dx == 0:
+            if x != self.x:
+                return False
+            d = (y - self.y) * self.dy
+        else:
+            if y != self.y:
+                return False
+            d = (x - self.x) * self.dx
+        return d >= 0 and d*2 < self.segments
+
+    # Returns the range of segments that land inside 0..size along the beam,
+    #   where start is where segment 0 lands and step is +1 or -1
+    def visibleSegments(self, start, step, size):
+        if step > 0:
+            first = max(0, math.ceil(-start))
+            last = min(self.segments, math.ceil(size - start))
+        else:
+            first = max(0, math.floor(start - size) + 1)
+            last = min(self.segments, math.floor(start) + 1)
+        return range(first, last)
+
+    def draw(self, world):
+        drawX = (self.x + world.windowOffsetX)*2
+        drawY = (self.y + world.windowOffsetY)*2
+        if self.dx == 0:
+            if not (drawX >= 0 and drawX < WIDTH*2):
+                return
+            tex = beamTexV
+            run = self.visibleSegments(drawY, self.dy, HEIGHT*2)
+        else:
+            if not (drawY >= 0 and drawY < HEIGHT*2):
+                return
+            tex = beamTexH
+            run = self.visibleSegments(drawX, self.dx, WIDTH*2)
+        for i in run:
+            drawTexture(tex[flickerRng.randrange(0,3)], drawX + self.dx*i + 0.5, drawY + self.dy*i + 0.5, 0)
+
+# Texture files for walls and floors. Floors pick one at random, so the plain
+#   ground is in there 8 times to make the blip rare.
+WALL_TEXTURES = tuple("player/wall_{}.png".format(x) for x in range(0,12))
+FLOOR_TEXTURES = ("player/ground.png",)*8 + ("player/ground_blip.png",)
+
+# Flips a wall or floor on each axis with a coin toss, X then Y. That is two
+#   rolls rather than one randrange(0,4), which keeps levels for a seed the
+#   same as they have always been.
+def rollFlip(rng):
+    flip = 0
+    if rng.choice([True, False]):
+        flip |= FLIP_X
+    if rng.choice([True, False]):
+        flip |= FLIP_Y
+    return flip
+
+# Walls and floors roll their looks from rng. Whatever builds them into a
+#   world hands them the world's (see World.rng) or a chunk's own (see
+#   ChunkMap), the random module is only there for ones made on their own.
+#   Turrets take an rng the same way.
 class Wall(Entity):
-    def __init__(self, name, x, y):
-        super(Wall, self).__init__(name, ["player/wall_{}.png".format(x) for x in range(0,12)], x, y)
-        self.frameNum = 0 + random.randrange(0,12)
-        self.randX = random.choice([True, False])
-        self.randY = random.choice([True, False])
-
-    def update(self):
+    __slots__ = ("flip", "phase")
+
+    # phase and flip can be given instead of rolled, e.g. by loadLevelCache()
+    def __init__(self, name, x, y, rng=random, phase=None, flip=None):
+        super(Wall, self).__init__(name, WALL_TEXTURES, x, y)
+        if phase is None:
+            phase = rng.randrange(0,12)
+        if flip is None:
+            flip = rollFlip(rng)
+        self.phase = phase
+        self.flip = flip
+
+    def update(self, world):
         pass
 
-    def draw(self):
-        drawX = self.x + windowOffsetX
-        drawY = self.y + windowOffsetY
+    def draw(self, world):
+        drawX = self.x + world.windowOffsetX
+        drawY = self.y + world.windowOffsetY
 
         if (drawX >= 0 and drawX < WIDTH) and (drawY >=0 and drawY < HEIGHT):
-            texture16[self.texName[int(self.frameNum)]].draw(drawX, drawY, 0, fX=self.randX, fY=self.randY)
-        self.frameNum += 0.5
-        if (self.frameNum >= 12):
-            self.frameNum = 0
+            drawTexture(self.tex[world.animFrame(12, self.phase, 2)], drawX, drawY, 0, self.flip)
 
 class Floor(Entity):
-    def __init__(self, name, x, y):
-        super(Floor, self).__init__(name, [random.choice(["player/ground.png"]*8 + ["player/ground_blip.png"])], x, y)
+    __slots__ = ("flip",)
+
+    # Floors never change how they look, so they get baked into the tilemap
+    bakeable = True
+
+    def __init__(self, name, x, y, rng=random, texture=None, flip=None):
+        if texture is None:
+            texture = rng.choice(FLOOR_TEXTURES)
+        super(Floor, self).__init__(name, (texture,), x, y)
         self.allow = True
-        self.randX = random.choice([True, False])
-        self.randY = random.choice([True, False])
+        if flip is None:
+            flip = rollFlip(rng)
+        self.flip = flip
 
-    def draw(self):
-        drawX = self.x + windowOffsetX
-        drawY = self.y + windowOffsetY
+    def draw(self, world):
+        drawX = self.x + world.windowOffsetX
+        drawY = self.y + world.windowOffsetY
         if (drawX >= 0 and drawX < WIDTH) and (drawY >=0 and drawY < HEIGHT):
-            texture16[self.texName[self.frameNum]].draw(drawX, drawY, fX=self.randX, fY=self.randY)
+            drawTexture(self.tex[self.frameNum], drawX, drawY, flip=self.flip)
 
-# The player class extends Entity by listening for keyboard events.
+PLAYER_TEXTURES = tuple("player/char_H{}.png".format(x) for x in range(0,12)) + tuple("player/char_V{}.png".format(x) for x in range(0,12))
+
+# The player class extends Entity by listening for keyboard events. These
+#   come from the world's input, unless the player is given an input of its
+#   own (like a remote player, see server.py). Those don't move the camera.
 class Player(Entity):
-    def __init__(self, name, x=WIDTH/2, y=HEIGHT/2):
-        super(Player, self).__init__(name, ["player/char_H{}.png".format(x) for x in range(0,12)] + ["player/char_V{}.png".format(x) for x in range(0,12)], x, y)
+    tickable = True
+
+    def __init__(self, name, x=WIDTH/2, y=HEIGHT/2, input=None):
+        super(Player, self).__init__(name, PLAYER_TEXTURES, x, y)
+        self.input = input
         self.cooldown = 0
         self.cooldownTime = 2
-        self.frameNum = 1
-        self.texHnames = [x for x in self.texName if "H" in x]
-        self.texVnames = [x for x in self.texName if "V" in x]
-
-    def update(self):
+        self.phase = 1
+        self.texH = self.tex[:12]
+        self.texV = self.tex[12:]
+
+    def update(self, world):
+        input = self.input
+        if input is None:
+            input = world.input
+        # Wake any turrets that went to sleep with nobody near them
+        for turret in world.entitiesNear(self.x, self.y, IDLE_RANGE_SQ, StationaryTurret):
+            world.scheduler.wake(turret)
         self.cooldown -= 1
         if (self.cooldown <= 0):
             wantGoX = 0
             wantGoY = 0
-            if pyxel.btn(pyxel.KEY_UP):
+            if input.btn("up"):
                 wantGoY -= 1
                 self.dir = "N"
-            if pyxel.btn(pyxel.KEY_DOWN):
+            if input.btn("down"):
                 wantGoY += 1
                 self.dir = "S"
-            if pyxel.btn(pyxel.KEY_LEFT):
+            if input.btn("left"):
                 wantGoX -= 1
                 self.dir = "E"
-            if pyxel.btn(pyxel.KEY_RIGHT):
+            if input.btn("right"):
                 wantGoX += 1
                 self.dir = "W"
 
             if (wantGoX != 0 or wantGoY != 0):
-                if canGo(self.x, self.y, wantGoX, wantGoY):
-                    global windowOffsetX, windowOffsetY
-                    self.x = self.x + wantGoX
-                    self.y = self.y + wantGoY
+                if world.canGo(self.x, self.y, wantGoX, wantGoY):
+                    world.moveEntity(self, self.x + wantGoX, self.y + wantGoY)
                     self.cooldown = self.cooldownTime
-                    windowOffsetX -= wantGoX
-                    windowOffsetY -= wantGoY
+                    if self.input is None:
+                        world.windowOffsetX -= wantGoX
+                        world.windowOffsetY -= wantGoY
 
-    def draw(self):
-        drawX = self.x + windowOffsetX
-        drawY = self.y + windowOffsetY
+    def draw(self, world):
+        drawX = self.x + world.windowOffsetX
+        drawY = self.y + world.windowOffsetY
 
-        fX = False
-        fY = False
-        ch = self.texHnames
+        flip = 0
+        ch = self.texH
 
         if self.dir == "N":
-            fX = True
-            fY = True
-            ch = self.texVnames
+            flip = FLIP_X | FLIP_Y
+            ch = self.texV
         if self.dir == "S":
-            fX = False
-            fY = False
-            ch = self.texVnames
+            flip = 0
+            ch = self.texV
         if self.dir == "E":
-            fX = False
-            fY = False
-            ch = self.texHnames
+            flip = 0
+            ch = self.texH
         if self.dir == "W":
-            fX = True
-            fY = True
-            ch = self.texHnames
+            flip = FLIP_X | FLIP_Y
+            ch = self.texH
 
         if (drawX >= 0 and drawX < WIDTH) and (drawY >=0 and drawY < HEIGHT):
-            texture16[ch[self.frameNum - 1]].draw(drawX, drawY, 0, fX=fX, fY=fY)
-        self.frameNum += 1
-        if (self.frameNum >= 12):
-            self.frameNum = 0
+            drawTexture(ch[world.animFrame(12, self.phase) - 1], drawX, drawY, 0, flip)
+
+# Turrets start charging when a player is closer than sqrt(ARM_RANGE_SQ) tiles
+#   and in sight. TURRET_SIGHT is how far they look, which has to cover that.
+ARM_RANGE_SQ = 10
+TURRET_SIGHT = 4
+
+# Turrets with no charge and no player closer than sqrt(IDLE_RANGE_SQ) have
+#   nothing to do. Stationary ones go to sleep until a player comes that close
+#   and wakes them (see Player.update). Moving ones still turn on screen, so
+#   they only get ticked every IDLE_EVERY ticks instead. A player moves at
+#   most a tile every other tick, so the gap between the two ranges is wide
+#   enough that nobody gets within arming range of an idle turret before it
+#   next looks.
+IDLE_RANGE_SQ = 40
+IDLE_EVERY = 4
+
+# Has a turret got nothing to do? Tells the scheduler whether and how often
+#   to tick it.
+def idleTurret(world, turret):
+    idle = turret.charge == 0 and next(world.entitiesNear(turret.x, turret.y, IDLE_RANGE_SQ, Player), None) is None
+    if idle and type(turret) is StationaryTurret:
+        world.scheduler.sleep(turret)
+    else:
+        world.scheduler.setEvery(turret, IDLE_EVERY if idle else 1)
+
+STATIONARY_TURRET_TEXTURES = ("player/turret_H.png", "player/turret_V.png")
 
 class StationaryTurret(Entity):
-    def __init__(self, name, x=WIDTH/2, y=HEIGHT/2, dir="N"):
-        super(StationaryTurret, self).__init__(name, ["player/turret_H.png", "player/turret_V.png"], x, y)
-        self.texHnames = [x for x in self.texName if "H" in x]
-        self.texVnames = [x for x in self.texName if "V" in x]
+    tickable = True
+
+    def __init__(self, name, x=WIDTH/2, y=HEIGHT/2, dir="N", rng=random):
+        super(StationaryTurret, self).__init__(name, STATIONARY_TURRET_TEXTURES, x, y)
+        self.texH = self.tex[:1]
+        self.texV = self.tex[1:]
         self.dir = dir
         self.charge = 0
-        self.chargeTexNames = []
-        self.HbeamNames = []
-        self.VbeamNames = []
-        self.owner = random.randrange(0,32000) # good enough
-
-        for tex in ["player/turret_charge_{}.png".format(x) for x in range(0,4)]:
-            texName = tex.rsplit(".",1)[0] # remove file extension
-            self.chargeTexNames.append(texName)
-            Drawn(texName, 8, tex)
-        for tex in ["player/beem_H{}.png".format(x) for x in range(0,3)]:
-            texName = tex.rsplit(".",1)[0]
-            self.HbeamNames.append(texName)
-            Drawn(texName, 8, tex)
-        for tex in ["player/beem_V{}.png".format(x) for x in range(0,3)]:
-            texName = tex.rsplit(".",1)[0]
-            self.VbeamNames.append(texName)
-            Drawn(texName, 8, tex)
+        self.owner = rng.randrange(0,32000) # good enough
+        registerTurretTextures()
 
-    def update(self):
+    def update(self, world):
         charge = 0
-        for entity in entities:
-            #print(entity)
-            if isinstance(entity, Player):
-                #print("{} is player!".format(entity))
-                xdiff = math.pow(entity.x - self.x, 2)
-                ydiff = math.pow(entity.y - self.y, 2)
-                if xdiff + ydiff < 10:
-                    #print("ARMING {} {}".format(self.x, self.y))
-                    charge += 0.5
+        for entity in world.entitiesNear(self.x, self.y, ARM_RANGE_SQ, Player):
+            if world.sight.canSee(self.x, self.y, entity.x, entity.y, TURRET_SIGHT):
+                #print("ARMING {} {}".format(self.x, self.y))
+                charge += 0.5
         if (charge == 0):
             if (self.charge > 0):
                 self.charge -= 1
@@ -289,105 +747,72 @@ class StationaryTurret(Entity):
             if self.charge < 3:
                 self.charge += 1
         if (self.charge == 3):
-            sounds["bzzz"].play(2)
-            self.placeLazer(self.dir)
-
-    def placeLazer(self, direction="N"):
-        count = 0
-        if direction == "N" or direction == "S":
-            beamNames = self.HbeamNames
-            if direction == "N":
-                for y in range(0, HEIGHT*4):
-                    yL = self.y - y/2
-                    lz = Lazer("{}{}".format(self.owner, y), self.x, yL, "N")
-                    lazers.append(lz)
-            if direction == "S":
-                for y in range(0, HEIGHT*4):
-                    yL = self.y + y/2
-                    lz = Lazer("{}{}".format(self.owner, y), self.x, yL, "S")
-                    lazers.append(lz)
-
-        elif direction == "E" or direction == "W":
-            beamNames = self.VbeamNames
-            if direction == "E":
-                for x in range(0, WIDTH*4):
-                    xL = self.x - x/2
-                    lz = Lazer("{}{}".format(self.owner, x), xL, self.y, "E")
-                    lazers.append(lz)
-            if direction == "W":
-                for x in range(0, WIDTH*4):
-                    xL = self.x + x/2
-                    lz = Lazer("{}{}".format(self.owner, x), xL, self.y, "W")
-                    lazers.append(lz)
-
-    def draw(self):
-        drawX = self.x + windowOffsetX
-        drawY = self.y + windowOffsetY
-
-        fX = False
-        fY = False
-        ch = self.texHnames
+            sounds["bzzz"].play(world, 2)
+            self.placeLazer(world, self.dir)
+        idleTurret(world, self)
+
+    def placeLazer(self, world, direction="N"):
+        world.lazers.append(Beam(world, self.owner, self.x, self.y, direction))
+        if profiler.enabled:
+            profiler.count("lazers")
+
+    def draw(self, world):
+        drawX = self.x + world.windowOffsetX
+        drawY = self.y + world.windowOffsetY
+
+        flip = 0
+        ch = self.texH
 
         if self.dir == "N":
-            fX = True
-            fY = True
-            ch = self.texVnames
+            flip = FLIP_X | FLIP_Y
+            ch = self.texV
         if self.dir == "S":
-            fX = False
-            fY = False
-            ch = self.texVnames
+            flip = 0
+            ch = self.texV
         if self.dir == "E":
-            fX = False
-            fY = False
-            ch = self.texHnames
+            flip = 0
+            ch = self.texH
         if self.dir == "W":
-            fX = True
-            fY = True
-            ch = self.texHnames
+            flip = FLIP_X | FLIP_Y
+            ch = self.texH
 
         if (drawX >= 0 and drawX < WIDTH) and (drawY >=0 and drawY < HEIGHT):
-            texture16[ch[0]].draw(drawX, drawY, 0, fX=fX, fY=fY)
-            texture8[self.chargeTexNames[int(self.charge)]].draw(drawX*2+0.5, drawY*2+0.5, 0)
+            drawTexture(ch[0], drawX, drawY, 0, flip)
+            drawTexture(chargeTex[int(self.charge)], drawX*2+0.5, drawY*2+0.5, 0)
 
+MOVING_TURRET_TEXTURES = tuple("player/turret_H{}.png".format(x) for x in range(0,12)) + tuple("player/turret_V{}.png".format(x) for x in range(0,12))
+
+# Ticks a chasing turret waits between steps
+CHASE_COOLDOWN = 4
+
+# With chase set, the turret follows the world's flow field (see FlowField)
+#   towards the nearest player, facing the way it goes, and only spins while
+#   no player is within FLOW_RADIUS steps
 class MovingTurret(Entity):
-    def __init__(self, name, x=WIDTH/2, y=HEIGHT/2, dir="N"):
-        super(MovingTurret, self).__init__(name, ["player/turret_H{}.png".format(x) for x in range(0,12)] + ["player/turret_V{}.png".format(x) for x in range(0,12)], x, y)
+    tickable = True
+
+    def __init__(self, name, x=WIDTH/2, y=HEIGHT/2, dir="N", chase=False, rng=random):
+        super(MovingTurret, self).__init__(name, MOVING_TURRET_TEXTURES, x, y)
         self.cooldown = 0
-        self.cooldownTime = 2
-        self.frameNum = 1
-        self.texHnames = [x for x in self.texName if "H" in x]
-        self.texVnames = [x for x in self.texName if "V" in x]
+        self.cooldownTime = CHASE_COOLDOWN
+        self.phase = 1
+        self.texH = self.tex[:12]
+        self.texV = self.tex[12:]
         self.dir = dir
         self.charge = 0
-        self.chargeTexNames = []
-        self.HbeamNames = []
-        self.VbeamNames = []
-        self.owner = random.randrange(0,32000) # good enough
-
-        for tex in ["player/turret_charge_{}.png".format(x) for x in range(0,4)]:
-            texName = tex.rsplit(".",1)[0] # remove file extension
-            self.chargeTexNames.append(texName)
-            Drawn(texName, 8, tex)
-        for tex in ["player/beem_H{}.png".format(x) for x in range(0,3)]:
-            texName = tex.rsplit(".",1)[0]
-            self.HbeamNames.append(texName)
-            Drawn(texName, 8, tex)
-        for tex in ["player/beem_V{}.png".format(x) for x in range(0,3)]:
-            texName = tex.rsplit(".",1)[0]
-            self.VbeamNames.append(texName)
-            Drawn(texName, 8, tex)
-
-    def update(self):
+        self.chase = chase
+        # The tick it was last updated on, so it can catch up on any turns
+        #   it missed while idle
+        self.lastTick = None
+        self.owner = rng.randrange(0,32000) # good enough
+        registerTurretTextures()
+
+    def update(self, world):
         charge = 0
-        for entity in entities:
-            #print(entity)
-            if isinstance(entity, Player):
-                #print("{} is player!".format(entity))
-                xdiff = math.pow(entity.x - self.x, 2)
-                ydiff = math.pow(entity.y - self.y, 2)
-                if xdiff + ydiff < 10:
-                    #print("ARMING {} {}".format(self.x, self.y))
-                    charge += 0.5
+        for entity in world.entitiesNear(self.x, self.y, ARM_RANGE_SQ, Player):
+            if world.sight.canSee(self.x, self.y, entity.x, entity.y, TURRET_SIGHT):
+                #print("ARMING {} {}".format(self.x, self.y))
+                charge += 0.5
         if (charge == 0):
             if (self.charge > 0):
                 self.charge -= 1
@@ -395,69 +820,25 @@ class MovingTurret(Entity):
             if self.charge < 3:
                 self.charge += 1
         if (self.charge == 3):
-            sounds["bzzz"].play(2)
-            self.placeLazer(self.dir)
-
-    def placeLazer(self, direction="N"):
-        count = 0
-        if direction == "N" or direction == "S":
-            beamNames = self.HbeamNames
-            if direction == "N":
-                for y in range(0, HEIGHT*4):
-                    yL = self.y - y/2
-                    lz = Lazer("{}{}".format(self.owner, y), self.x, yL, "N")
-                    lazers.append(lz)
-            if direction == "S":
-                for y in range(0, HEIGHT*4):
-                    yL = self.y + y/2
-                    lz = Lazer("{}{}".format(self.owner, y), self.x, yL, "S")
-                    lazers.append(lz)
-
-        elif direction == "E" or direction == "W":
-            beamNames = self.VbeamNames
-            if direction == "E":
-                for x in range(0, WIDTH*4):
-                    xL = self.x - x/2
-                    lz = Lazer("{}{}".format(self.owner, x), xL, self.y, "E")
-                    lazers.append(lz)
-            if direction == "W":
-                for x in range(0, WIDTH*4):
-                    xL = self.x + x/2
-                    lz = Lazer("{}{}".format(self.owner, x), xL, self.y, "W")
-                    lazers.append(lz)
-
-    def draw(self):
-        drawX = self.x + windowOffsetX
-        drawY = self.y + windowOffsetY
-
-        fX = False
-        fY = False
-        ch = self.texHnames
-
-        if self.dir == "N":
-            fX = True
-            fY = True
-            ch = self.texVnames
-        if self.dir == "S":
-            fX = False
-            fY = False
-            ch = self.texVnames
-        if self.dir == "E":
-            fX = False
-            fY = False
-            ch = self.texHnames
-        if self.dir == "W":
-            fX = True
-            fY = True
-            ch = self.texHnames
-
-        if (drawX >= 0 and drawX < WIDTH) and (drawY >=0 and drawY < HEIGHT):
-            texture16[ch[self.frameNum - 1]].draw(drawX, drawY, 0, fX=fX, fY=fY)
-            texture8[self.chargeTexNames[self.charge]].draw(drawX*2+0.5, drawY*2+0.5, 0)
-        self.frameNum += 1
-        if (self.frameNum >= 12):
-            self.frameNum = 0
-        if (self.frameNum == 3):
+            sounds["bzzz"].play(world, 2)
+            self.placeLazer(world, self.dir)
+
+        lastTick = self.lastTick
+        if lastTick is None:
+            lastTick = world.tick - 1
+        self.lastTick = world.tick
+
+        if self.chase and self.chaseStep(world):
+            world.scheduler.setEvery(self, 1)
+            return
+        idleTurret(world, self)
+
+        # Spinning happens here rather than in draw() so the turret keeps
+        #   turning while it is off screen and not being drawn. It turns on
+        #   every tick where animFrame(12, phase) is 3, including the ones
+        #   skipped since lastTick.
+        turns = (world.tick + self.phase - 3) // 12 - (lastTick + self.phase - 3) // 12
+        for i in range(turns % 4):
             if self.dir == "N":
                 self.dir = "E"
             elif self.dir == "E":
@@ -467,84 +848,891 @@ class MovingTurret(Entity):
             elif self.dir == "W":
                 self.dir = "N"
 
-# This tells you if an entity is permitted to go somewhere.
-# From x,y with velocity a,b
-def canGo(x, y, a, b):
-    # Don't allow to exit past the edges of the screen
-    if ((x+a) < 0 or (x+a) >= GL_WIDTH):
-        sounds["collide"].play(0)
-        return False
-    if ((y+b) < 0 or (y+b) >= GL_HEIGHT):
-        sounds["collide"].play(0)
-        return False
+    # Turns towards the nearest player and steps that way when off cooldown.
+    #   Stops next to them rather than on top of them. Returns False if there
+    #   is no way to any player close enough.
+    def chaseStep(self, world):
+        step = world.flow.stepFrom(self.x, self.y)
+        if step is None:
+            return False
+        self.dir = STEP_DIR[step]
+        self.cooldown -= 1
+        if self.cooldown <= 0 and world.flow.distanceFrom(self.x, self.y) > 1:
+            world.moveEntity(self, self.x + step[0], self.y + step[1])
+            self.cooldown = self.cooldownTime
+        return True
 
-    # Basic structure checks in direction
-    for s in structures:
-        if (s.x == (x+a)) and (s.y == (y+b)):
-            if s.allow:
-                return True
-            sounds["collide"].play(0)
+    def placeLazer(self, world, direction="N"):
+        world.lazers.append(Beam(world, self.owner, self.x, self.y, direction))
+        if profiler.enabled:
+            profiler.count("lazers")
+
+    def draw(self, world):
+        drawX = self.x + world.windowOffsetX
+        drawY = self.y + world.windowOffsetY
+
+        flip = 0
+        ch = self.texH
+
+        if self.dir == "N":
+            flip = FLIP_X | FLIP_Y
+            ch = self.texV
+        if self.dir == "S":
+            flip = 0
+            ch = self.texV
+        if self.dir == "E":
+            flip = 0
+            ch = self.texH
+        if self.dir == "W":
+            flip = FLIP_X | FLIP_Y
+            ch = self.texH
+
+        if (drawX >= 0 and drawX < WIDTH) and (drawY >=0 and drawY < HEIGHT):
+            drawTexture(ch[world.animFrame(12, self.phase) - 1], drawX, drawY, 0, flip)
+            drawTexture(chargeTex[self.charge], drawX*2+0.5, drawY*2+0.5, 0)
+
+# One thing the Scheduler ticks: every how many ticks, which tick it is next
+#   due on, and where it comes in the order actors were added in
+class Actor():
+    __slots__ = ("obj", "every", "due", "live", "seq")
+
+    def __init__(self, obj, every, due, seq):
+        self.obj = obj
+        self.every = every
+        self.due = due
+        self.live = True
+        self.seq = seq
+
+# Works out what gets updated each tick. Only tickable things get added, so
+#   walls and floors cost nothing, and each actor can be put to sleep (not
+#   ticked at all until woken) or ticked only every so many ticks. Actors run
+#   in the order they were added in.
+class Scheduler():
+    def __init__(self):
+        # Awake and sleeping actors, by id() of the thing being ticked
+        self.awake = {}
+        self.asleep = {}
+        # How many actors have been added, which numbers them in order
+        self.added = 0
+        # Set when woken actors have gone in at the end of awake, out of order
+        self.unsorted = False
+
+    def add(self, obj, every=1):
+        if obj.tickable and id(obj) not in self.awake and id(obj) not in self.asleep:
+            self.awake[id(obj)] = Actor(obj, every, 0, self.added)
+            self.added += 1
+
+    def remove(self, obj):
+        actor = self.awake.pop(id(obj), None) or self.asleep.pop(id(obj), None)
+        if actor is not None:
+            actor.live = False
+
+    # Stops ticking obj until wake() is called on it
+    def sleep(self, obj):
+        actor = self.awake.pop(id(obj), None)
+        if actor is not None:
+            self.asleep[id(obj)] = actor
+
+    # Starts ticking obj again, from the next tick, in the same place in the
+    #   order as before it slept
+    def wake(self, obj):
+        actor = self.asleep.pop(id(obj), None)
+        if actor is not None:
+            actor.due = 0
+            self.awake[id(obj)] = actor
+            self.unsorted = True
+
+    # Ticks obj every `every` ticks from now on. Going down to a shorter gap
+    #   takes effect straight away.
+    def setEvery(self, obj, every):
+        actor = self.awake.get(id(obj))
+        if actor is not None and actor.every != every:
+            actor.due = min(actor.due, actor.due - actor.every + every)
+            actor.every = every
+
+    # How many actors are awake
+    def __len__(self):
+        return len(self.awake)
+
+    # Updates every actor due on tick. Anything added during the tick waits
+    #   for the next one.
+    def run(self, world, tick):
+        if self.unsorted:
+            self.awake = dict(sorted(self.awake.items(), key=lambda item: item[1].seq))
+            self.unsorted = False
+        ran = 0
+        if not profiler.enabled:
+            for actor in list(self.awake.values()):
+                if actor.due <= tick and actor.live:
+                    actor.due = tick + actor.every
+                    actor.obj.update(world)
+                    ran += 1
+            return ran
+
+        t = time.perf_counter()
+        for actor in list(self.awake.values()):
+            if actor.due <= tick and actor.live:
+                actor.due = tick + actor.every
+                actor.obj.update(world)
+                ran += 1
+                t = profiler.lap(profiler.classKey("update", type(actor.obj)), t)
+        profiler.count("actorsTicked", ran)
+        profiler.count("actorsAwake", len(self.awake))
+        return ran
+
+# How many steps out from the players a flow field reaches. Anything further
+#   away gets no directions, which keeps rebuilding it cheap however big
+#   (or endless) the level is.
+FLOW_RADIUS = 24
+
+# A distance map out from every player in a world, over the tiles entities can
+#   walk. Each tile it reaches knows how many steps it is from the nearest
+#   player and which step takes it one closer, so any number of chasers can
+#   look up where to go without searching for themselves. It only gets
+#   rebuilt when a player moves to another tile or the structures change.
+#   Steps are N/S/E/W only, the way turrets move.
+class FlowField():
+    def __init__(self, world, radius=FLOW_RADIUS):
+        self.world = world
+        self.radius = radius
+        # Steps to the nearest player, and the step towards them, by tile
+        self.distance = {}
+        self.toward = {}
+        # What the field was built for, see refresh()
+        self.builtFor = None
+        self.checkedTick = None
+
+    # Can an entity step onto x,y? Same as World.canGo for straight steps,
+    #   without the bump sound.
+    def passable(self, x, y):
+        world = self.world
+        if world.bounded and not (0 <= x < GL_WIDTH and 0 <= y < GL_HEIGHT):
             return False
+        return world.allowAt(x, y) != False
+
+    # Rebuilds the field if the players or the structures have changed since
+    #   it was built. Only looks once per tick.
+    def refresh(self):
+        world = self.world
+        if self.checkedTick == world.tick:
+            return
+        self.checkedTick = world.tick
+        players = tuple(sorted((int(p.x), int(p.y)) for p in world.entitiesOfType(Player)))
+        key = (players, world.structureVersion)
+        if key != self.builtFor:
+            self.build(players)
+            self.builtFor = key
+
+    # Breadth first search out from the players, up to radius steps
+    def build(self, players):
+        distance = {}
+        toward = {}
+        queue = collections.deque()
+        for p in players:
+            if p not in distance:
+                distance[p] = 0
+                queue.append(p)
+        passable = self.passable
+        radius = self.radius
+        while queue:
+            x, y = queue.popleft()
+            d = distance[(x, y)] + 1
+            if d > radius:
+                continue
+            for dx, dy in ((0, -1), (0, 1), (-1, 0), (1, 0)):
+                n = (x + dx, y + dy)
+                if n not in distance and passable(n[0], n[1]):
+                    distance[n] = d
+                    toward[n] = (-dx, -dy)
+                    queue.append(n)
+        self.distance = distance
+        self.toward = toward
+        if profiler.enabled:
+            profiler.count("flowRebuilds")
+            profiler.count("flowTiles", len(distance))
+
+    # The step (dx, dy) from x,y towards the nearest player, or None if x,y is
+    #   out of reach or already has a player on it
+    def stepFrom(self, x, y):
+        self.refresh()
+        return self.toward.get((int(x), int(y)))
+
+    # Steps from x,y to the nearest player, or None if out of reach
+    def distanceFrom(self, x, y):
+        self.refresh()
+        return self.distance.get((int(x), int(y)))
+
+# Field of view. Sight is cached per (origin tile, radius), and the cache is
+#   bucketed by SIGHT_CELL x SIGHT_CELL blocks of tiles so a wall changing
+#   only throws away what could have been looked at across that block. The
+#   whole cache is dropped if it grows past SIGHT_CACHE_SIZE.
+SIGHT_CELL = 8
+SIGHT_CACHE_SIZE = 4096
+
+# How each of the 8 octants maps onto the grid, for Visibility.castLight
+OCTANTS = ((1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+    (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1))
+
+# What can be seen from where in a world. Walls block sight, everything else
+#   (floors and empty space) doesn't. Uses recursive shadowcasting: each
+#   octant is scanned row by row out from the origin, and a wall splits the
+#   rest of the scan into the part on either side of its shadow.
+class Visibility():
+    def __init__(self, world):
+        self.world = world
+        # Tiles seen, by (x, y, radius) of where they were seen from
+        self.cache = {}
+        # Cache keys, by the SIGHT_CELL block they looked over
+        self.cells = {}
+
+    def opaque(self, x, y):
+        return self.world.allowAt(x, y) == False
+
+    # Returns the set of tiles within radius of x,y that can be seen from it
+    def visibleFrom(self, x, y, radius):
+        x = int(x)
+        y = int(y)
+        key = (x, y, radius)
+        seen = self.cache.get(key)
+        if seen is not None:
+            return seen
+        seen = {(x, y)}
+        for xx, xy, yx, yy in OCTANTS:
+            self.castLight(x, y, 1, 1.0, 0.0, radius, xx, xy, yx, yy, seen)
+        seen = frozenset(seen)
+        if len(self.cache) >= SIGHT_CACHE_SIZE:
+            self.clear()
+        self.cache[key] = seen
+        for cX in range(int((x - radius) // SIGHT_CELL), int((x + radius) // SIGHT_CELL) + 1):
+            for cY in range(int((y - radius) // SIGHT_CELL), int((y + radius) // SIGHT_CELL) + 1):
+                self.cells.setdefault((cX, cY), set()).add(key)
+        if profiler.enabled:
+            profiler.count("sightCasts")
+        return seen
+
+    # Scans one octant from row outwards, between the slopes start and end
+    def castLight(self, cx, cy, row, start, end, radius, xx, xy, yx, yy, seen):
+        if start < end:
+            return
+        radiusSq = radius * radius
+        opaque = self.opaque
+        newStart = 0.0
+        for j in range(row, radius + 1):
+            dy = -j
+            blocked = False
+            for dx in range(-j, 1):
+                left = (dx - 0.5) / (dy + 0.5)
+                right = (dx + 0.5) / (dy - 0.5)
+                if start < right:
+                    continue
+                if end > left:
+                    break
+                x = cx + dx*xx + dy*xy
+                y = cy + dx*yx + dy*yy
+                if dx*dx + dy*dy <= radiusSq:
+                    seen.add((x, y))
+                wall = opaque(x, y)
+                if blocked:
+                    if wall:
+                        newStart = right
+                    else:
+                        blocked = False
+                        start = newStart
+                elif wall and j < radius:
+                    blocked = True
+                    self.castLight(cx, cy, j + 1, start, left, radius, xx, xy, yx, yy, seen)
+                    newStart = right
+            if blocked:
+                break
+
+    # Can tile toX,toY be seen from fromX,fromY, looking no further than radius?
+    def canSee(self, fromX, fromY, toX, toY, radius):
+        return (int(toX), int(toY)) in self.visibleFrom(fromX, fromY, radius)
+
+    # Forgets anything that could have been seen across tile x,y, for when
+    #   what is there changes
+    def invalidateAt(self, x, y):
+        keys = self.cells.pop((int(x // SIGHT_CELL), int(y // SIGHT_CELL)), None)
+        if keys:
+            for key in keys:
+                self.cache.pop(key, None)
+
+    def clear(self):
+        self.cache.clear()
+        self.cells.clear()
+
+# A game world: the structures and entities in it and the indexes over them,
+#   the level, the camera, the clock, where its input comes from, where its
+#   sounds go and the RNG everything in it is rolled from. Worlds don't share
+#   anything but registered textures and sounds (and the profiler, which only
+#   watches), so any number of them can run side by side and each comes out
+#   the same for the same seed however they are interleaved (see Simulation).
+#   The one in `world` is the one the game window shows.
+class World():
+    def __init__(self, input=None, seed=None, headless=False, audio=None):
+        # Entities (should not) be able to walk through structures,
+        #   unless they have "allow" set to True
+        self.structures = []
+
+        # Structures indexed by the (x, y) tile they sit on, so "what is at
+        #   this cell" questions don't have to walk the whole structures list.
+        #   Use addStructure and removeStructure to keep the two in sync.
+        self.structureMap = {}
+
+        # Entities can move all over the place and stand in the same cube, but
+        #   not walk into structures unless the structure has "allow" set
+        self.entities = []
+
+        # Entities bucketed by which ENTITY_CELL x ENTITY_CELL block of tiles
+        #   they are in, so "who is near here" only has to look at the few
+        #   buckets around it. Use addEntity, removeEntity and moveEntity to
+        #   keep this up to date.
+        self.entityGrid = {}
+
+        # Entities by their exact class, so asking for e.g. every Player
+        #   doesn't mean going through every entity
+        self.entityTypes = {}
+
+        # These contain all fireables and are cleared every tick
+        self.lazers = []
+
+        # The array-backed level made by worldgen(..., arrayLevel=True), or
+        #   None. Structures take priority over it where they overlap.
+        self.level = None
+
+        # The ChunkMap streaming in a chunked or endless level, or None. Its
+        #   active chunks are what is in the structures list.
+        self.chunks = None
+
+        # Whether entities are kept inside GL_WIDTH x GL_HEIGHT. Endless
+        #   levels turn this off.
+        self.bounded = True
+
+        # The animation clock. update() counts this up once per tick, and
+        #   anything animated works out its frame from it (see animFrame)
+        #   instead of keeping and bumping a counter of its own every frame.
+        self.tick = 0
+
+        # Bumped whenever a structure is added or taken away, so anything
+        #   worked out from them (like the flow field) knows to redo it
+        self.structureVersion = 0
+
+        # Directions to the nearest player, for anything chasing them
+        self.flow = FlowField(self)
+
+        # What can be seen from where
+        self.sight = Visibility(self)
+
+        # What gets updated every tick. Anything added to the world that is
+        #   tickable goes in here.
+        self.scheduler = Scheduler()
+
+        # Window offsets for the panning feature
+        self.windowOffsetX = 0
+        self.windowOffsetY = 0
+
+        # What gets asked which keys are held, see KEYS
+        self.input = input
+        if self.input is None:
+            self.input = NullInput()
+
+        # Set when the quit key is pressed
+        self.quitRequested = False
+
+        # Where everything random in the world gets rolled from, so a seed
+        #   makes it come out the same every time
+        self.rng = random.Random(seed)
+
+        # Set for worlds nobody is shown (see Simulation). setup() doesn't
+        #   open a window for these, and their sounds go nowhere.
+        self.headless = headless
+
+        # What plays the world's sounds
+        self.audio = audio
+        if self.audio is None:
+            self.audio = NullAudio() if headless else QueuedAudio(PyxelAudio())
+
+        # Set once bakeLevel() has run on this world, after which new
+        #   structures get baked as they are added
+        self.baked = False
+
+    # Returns which of `frames` animation frames to show for something that
+    #   started `phase` frames in and steps one frame every `rate` ticks
+    def animFrame(self, frames, phase=0, rate=1):
+        return (int(self.tick / rate) + phase) % frames
+
+    # Adds a structure to the world and indexes it by its tile
+    def addStructure(self, s):
+        self.structureVersion += 1
+        self.structures.append(s)
+        if s.tickable:
+            self.scheduler.add(s)
+        self.structureMap.setdefault((s.x, s.y), []).append(s)
+        if not s.allow:
+            self.sight.invalidateAt(s.x, s.y)
+        if self.baked and s.bakeable:
+            bakeTile(s)
+
+    # Takes a structure back out of the world and the tile index
+    def removeStructure(self, s):
+        self.structures.remove(s)
+        self.unindexStructure(s)
+
+    # Takes a lot of structures out at once, going over the structures list
+    #   only once instead of once each
+    def removeStructures(self, batch):
+        if not batch:
+            return
+        gone = set(id(s) for s in batch)
+        self.structures[:] = [s for s in self.structures if id(s) not in gone]
+        for s in batch:
+            self.unindexStructure(s)
+
+    def unindexStructure(self, s):
+        self.structureVersion += 1
+        if s.tickable:
+            self.scheduler.remove(s)
+        if not s.allow:
+            self.sight.invalidateAt(s.x, s.y)
+        cell = self.structureMap.get((s.x, s.y))
+        if cell is not None:
+            cell.remove(s)
+            if not cell:
+                del self.structureMap[(s.x, s.y)]
+        if s.baked:
+            unbakeTile(self, s)
+
+    # Returns the structure at x,y, or None if that tile is empty. If more than
+    #   one structure got put on a tile, the first one placed wins.
+    def structureAt(self, x, y):
+        cell = self.structureMap.get((x, y))
+        if cell:
+            return cell[0]
+        return None
 
-    # Advanced structure checks on diagonals
-    if not (x == a or y == b):
-        xCheck = False
-        yCheck = False
-        for s in structures:
-            if (s.x == (x+a) and (s.y == y)):
-                xCheck = not s.allow
-            if (s.x == x) and (s.y == (y+b)):
-                yCheck = not s.allow
-        if xCheck and yCheck:
-            sounds["collide"].play(0)
+    # Adds an entity to the world, the entity grid and the type registry
+    def addEntity(self, e):
+        self.entities.append(e)
+        self.scheduler.add(e)
+        self.entityGrid.setdefault(entityBucket(e.x, e.y), []).append(e)
+        self.entityTypes.setdefault(type(e), []).append(e)
+
+    # Takes an entity back out of the world
+    def removeEntity(self, e):
+        self.entities.remove(e)
+        self.scheduler.remove(e)
+        bucket = entityBucket(e.x, e.y)
+        self.entityGrid[bucket].remove(e)
+        if not self.entityGrid[bucket]:
+            del self.entityGrid[bucket]
+        self.entityTypes[type(e)].remove(e)
+
+    # Moves an entity to x,y. Anything that moves an entity needs to go
+    #   through here, or entitiesNear won't find it any more.
+    def moveEntity(self, e, x, y):
+        old = entityBucket(e.x, e.y)
+        new = entityBucket(x, y)
+        e.x = x
+        e.y = y
+        if old != new:
+            self.entityGrid[old].remove(e)
+            if not self.entityGrid[old]:
+                del self.entityGrid[old]
+            self.entityGrid.setdefault(new, []).append(e)
+
+    # Returns the entities of exactly class kind
+    def entitiesOfType(self, kind):
+        return self.entityTypes.get(kind, ())
+
+    # Yields the entities closer than sqrt(radiusSq) to x,y, optionally only
+    #   those of exactly class kind. The radius is given squared so callers
+    #   with whole number ranges get exactly the same cut off as comparing
+    #   squared distances.
+    def entitiesNear(self, x, y, radiusSq, kind=None):
+        r = math.sqrt(radiusSq)
+        left, top = entityBucket(x - r, y - r)
+        right, bottom = entityBucket(x + r, y + r)
+        buckets = (right - left + 1) * (bottom - top + 1)
+        # With only a few of kind about, checking them all beats the buckets
+        if kind is not None and len(self.entitiesOfType(kind)) < buckets:
+            candidates = self.entitiesOfType(kind)
+        else:
+            grid = self.entityGrid
+            candidates = (e for bx in range(left, right + 1) for by in range(top, bottom + 1) for e in grid.get((bx, by), ()))
+        for e in candidates:
+            if kind is not None and type(e) is not kind:
+                continue
+            dx = e.x - x
+            dy = e.y - y
+            if dx*dx + dy*dy < radiusSq:
+                yield e
+
+    # Returns whether entities may stand on x,y according to whatever is
+    #   there, or None if there is nothing there at all
+    def allowAt(self, x, y):
+        s = self.structureAt(x, y)
+        if s is not None:
+            return s.allow
+        if self.level is not None:
+            return self.level.allowAt(x, y)
+        return None
+
+    # This tells you if an entity is permitted to go somewhere.
+    # From x,y with velocity a,b
+    def canGo(self, x, y, a, b):
+        if profiler.enabled:
+            profiler.count("canGo")
+        # Don't allow to exit past the edges of the screen
+        if self.bounded:
+            if ((x+a) < 0 or (x+a) >= GL_WIDTH):
+                sounds["collide"].play(self, 0)
+                return False
+            if ((y+b) < 0 or (y+b) >= GL_HEIGHT):
+                sounds["collide"].play(self, 0)
+                return False
+
+        # Basic structure checks in direction
+        allow = self.allowAt(x+a, y+b)
+        if allow is not None:
+            if allow:
+                return True
+            sounds["collide"].play(self, 0)
             return False
 
+        # Advanced structure checks on diagonals
+        if not (x == a or y == b):
+            xCheck = self.allowAt(x+a, y) == False
+            yCheck = self.allowAt(x, y+b) == False
+            if xCheck and yCheck:
+                sounds["collide"].play(self, 0)
+                return False
+
+        return True
+
+    # Runs one tick of the world
+    def update(self):
+        self.tick += 1
+        self.input.advance(self)
+        # F1 can turn the profiler on or off, so that goes before anything
+        #   looks at whether it is enabled
+        profiler.toggle(self.input.btn("profile"))
+        if profiler.enabled:
+            profiler.endFrame(self.tick - 1)
+            started = time.perf_counter()
+
+        # Quit if Q. Whoever runs the world takes it from there.
+        if self.input.btn("quit"):
+            self.quitRequested = True
+
+        # Play a sound if Space
+        if self.input.btn("space"):
+            sounds["level"].play(self, 1)
+
+        # Build the level around wherever the players got to
+        if self.chunks is not None:
+            self.chunks.stream()
+
+        # Clear all lazers
+        self.lazers.clear()
+
+        if profiler.enabled:
+            profiler.lap("update.input", started)
+
+        # Tick everything that is due. Things get ticked in the order they
+        #   were added to the world, so the player goes before the turrets
+        #   setup() adds after it.
+        self.scheduler.run(self, self.tick)
+        self.input.ticked(self)
+
+        # Play what got played this tick
+        self.audio.flush()
+        if profiler.enabled:
+            profiler.lap("update", started)
+
+    # A hash of everything that changes as the game runs: the clock, the
+    #   camera, the entities and the beams. Two worlds that have had the same
+    #   things happen to them hash the same.
+    def stateHash(self):
+        h = zlib.crc32(repr((self.tick, self.windowOffsetX, self.windowOffsetY, len(self.structures))).encode())
+        for e in self.entities:
+            h = zlib.crc32(repr((type(e).__name__, e.x, e.y, e.dir, getattr(e, "charge", 0))).encode(), h)
+        for beam in self.lazers:
+            h = zlib.crc32(repr((beam.x, beam.y, beam.dir, beam.segments)).encode(), h)
+        return h
+
+# Returns the entityGrid bucket for tile x,y
+def entityBucket(x, y):
+    return (int(x // ENTITY_CELL), int(y // ENTITY_CELL))
+
+# The world the game shows, and that update() and draw() run
+world = World()
+
+# Static geometry gets baked into Pyxel tilemaps so the whole visible floor is
+#   a handful of bltm calls instead of one blt per tile. A tilemap is 256x256
+#   cells of 8x8, which is 128x128 of our 16x16 tiles, so the level is laid out
+#   over a grid of tilemaps. Tiles that land outside of it just stay drawn the
+#   normal way.
+BAKE_BANK = 2
+BAKE_TM_TILES = 128
+BAKE_TM_COLS = 2
+BAKE_TM_ROWS = 2
+
+# Image Map 2 is cut into 16x16 slots. Slot 0 is plain background, and the
+#   rest are textures copied over with their flips already applied, since
+#   tilemaps can't flip. Only the top 64 slots are used for this.
+BAKE_SLOTS = 64
+bakeSlots = {}
+
+# Returns the slot in Image Map 2 holding texture handle h with the given
+#   flip, copying it over from Image Map 0 the first time it is asked for
+def bakeSlot(h, flip):
+    key = (h, flip)
+    slot = bakeSlots.get(key)
+    if slot is None:
+        slot = len(bakeSlots) + 1
+        if slot >= BAKE_SLOTS:
+            return None
+        src = textures[h]
+        fX = flip & FLIP_X
+        fY = flip & FLIP_Y
+        srcImg = pyxel.image(src.bank)
+        dstImg = pyxel.image(BAKE_BANK)
+        u = (slot % 16) * 16
+        v = int(slot / 16) * 16
+        for yP in range(0, 16):
+            for xP in range(0, 16):
+                sx = 15 - xP if fX else xP
+                sy = 15 - yP if fY else yP
+                dstImg.set(u + xP, v + yP, srcImg.get(src.xLoc + sx, src.yLoc + sy))
+        bakeSlots[key] = slot
+    return slot
+
+# Points the four tilemap cells under tile x,y at slot
+def setBakedTile(x, y, slot):
+    col = int(x / BAKE_TM_TILES)
+    row = int(y / BAKE_TM_TILES)
+    tm = pyxel.tilemap(row * BAKE_TM_COLS + col)
+    cx = (x - col * BAKE_TM_TILES) * 2
+    cy = (y - row * BAKE_TM_TILES) * 2
+    u = (slot % 16) * 2
+    v = int(slot / 16) * 2
+    for dx in range(0, 2):
+        for dy in range(0, 2):
+            tm.set(cx + dx, cy + dy, (v + dy) * 32 + u + dx)
+    dirtyViewCache(x, y)
+
+# Bakes one structure into the tilemaps. Returns False if it has to keep being
+#   drawn by itself.
+def bakeTile(s):
+    if s.x < 0 or s.x >= BAKE_TM_TILES * BAKE_TM_COLS:
+        return False
+    if s.y < 0 or s.y >= BAKE_TM_TILES * BAKE_TM_ROWS:
+        return False
+    slot = bakeSlot(s.tex[s.frameNum], s.flip)
+    if slot is None:
+        return False
+    setBakedTile(s.x, s.y, slot)
+    s.baked = True
     return True
 
-# This sets up the game
-def setup():
+# Takes a structure back out of the tilemaps. If something else baked is still
+#   on that tile it gets put back, otherwise the tile goes back to background.
+def unbakeTile(world, s):
+    s.baked = False
+    setBakedTile(s.x, s.y, 0)
+    other = world.structureAt(s.x, s.y)
+    if other is not None and other.baked:
+        bakeTile(other)
+
+# Bakes every static structure in the world. Call this once the level has
+#   been generated. The tilemaps are shared, so only the world being shown
+#   should be baked.
+def bakeLevel(world):
+    img = pyxel.image(BAKE_BANK)
+    for yP in range(0, 16):
+        for xP in range(0, 16):
+            img.set(xP, yP, 3)
+    for tm in range(0, BAKE_TM_COLS * BAKE_TM_ROWS):
+        pyxel.tilemap(tm).refimg = BAKE_BANK
+    for s in world.structures:
+        if s.bakeable and not s.baked:
+            bakeTile(s)
+    if world.level is not None:
+        world.level.bake()
+    world.baked = True
+    invalidateViewCache()
+
+# Draws the baked part of the level that is on screen, one bltm per tilemap
+def drawBakedLevel(world):
+    left = int(-world.windowOffsetX)
+    top = int(-world.windowOffsetY)
+    for row in range(0, BAKE_TM_ROWS):
+        y0 = max(top, row * BAKE_TM_TILES)
+        y1 = min(top + HEIGHT, (row + 1) * BAKE_TM_TILES)
+        if y0 >= y1:
+            continue
+        for col in range(0, BAKE_TM_COLS):
+            x0 = max(left, col * BAKE_TM_TILES)
+            x1 = min(left + WIDTH, (col + 1) * BAKE_TM_TILES)
+            if x0 >= x1:
+                continue
+            pyxel.bltm((x0 - left) * 16, (y0 - top) * 16, row * BAKE_TM_COLS + col,
+                (x0 - col * BAKE_TM_TILES) * 2, (y0 - row * BAKE_TM_TILES) * 2,
+                (x1 - x0) * 2, (y1 - y0) * 2)
+            if profiler.enabled:
+                profiler.count("bltm")
+
+# The baked background of the screen is also kept composed in Image Map 2,
+#   under the bake slots, so a frame only needs a few blts for it. It is a ring
+#   buffer: tile x,y always lives in the same cell, (x % WIDTH, y % HEIGHT), so
+#   when the camera moves only the strip that comes into view is redrawn, over
+#   the strip that just left. Cells also get redrawn when what is baked on
+#   them changes.
+VIEW_CACHE_Y = 64
+useViewCache = True
+
+# Tile left, top of what the cache holds, or None if it holds nothing yet
+viewCacheAt = None
+viewCacheDirty = set()
+
+# Throws the whole cache away, so the next frame composes it from scratch
+def invalidateViewCache():
+    global viewCacheAt
+    viewCacheAt = None
+    viewCacheDirty.clear()
+
+# Marks tile x,y for a redraw, if it is in the cache at all
+def dirtyViewCache(x, y):
+    if viewCacheAt is None:
+        return
+    left, top = viewCacheAt
+    if left <= x < left + WIDTH and top <= y < top + HEIGHT:
+        viewCacheDirty.add((x, y))
+
+# Copies whatever is baked on tile x,y into its cell of the cache
+def composeViewCell(img, x, y):
+    slot = 0
+    if 0 <= x < BAKE_TM_TILES * BAKE_TM_COLS and 0 <= y < BAKE_TM_TILES * BAKE_TM_ROWS:
+        col = int(x / BAKE_TM_TILES)
+        row = int(y / BAKE_TM_TILES)
+        cell = pyxel.tilemap(row * BAKE_TM_COLS + col).get((x - col * BAKE_TM_TILES) * 2, (y - row * BAKE_TM_TILES) * 2)
+        slot = int(cell / 64) * 16 + int((cell % 32) / 2)
+    img.copy((x % WIDTH) * 16, VIEW_CACHE_Y + (y % HEIGHT) * 16, BAKE_BANK,
+        (slot % 16) * 16, int(slot / 16) * 16, 16, 16)
+    if profiler.enabled:
+        profiler.count("cacheTiles")
+
+# Brings the cache up to date with the camera, redrawing only what changed
+def updateViewCache(world):
+    global viewCacheAt
+    left = int(-world.windowOffsetX)
+    top = int(-world.windowOffsetY)
+    img = pyxel.image(BAKE_BANK)
+    if viewCacheAt is None or abs(left - viewCacheAt[0]) >= WIDTH or abs(top - viewCacheAt[1]) >= HEIGHT:
+        cols = range(left, left + WIDTH)
+        rows = range(0)
+    else:
+        oldLeft, oldTop = viewCacheAt
+        if left > oldLeft:
+            cols = range(oldLeft + WIDTH, left + WIDTH)
+        else:
+            cols = range(left, oldLeft)
+        if top > oldTop:
+            rows = range(oldTop + HEIGHT, top + HEIGHT)
+        else:
+            rows = range(top, oldTop)
+    # New columns get redrawn whole, new rows only where they aren't one of
+    #   the new columns
+    for x in cols:
+        for y in range(top, top + HEIGHT):
+            composeViewCell(img, x, y)
+    for y in rows:
+        for x in range(left, left + WIDTH):
+            if x not in cols:
+                composeViewCell(img, x, y)
+    viewCacheAt = (left, top)
+    for x, y in viewCacheDirty:
+        if left <= x < left + WIDTH and top <= y < top + HEIGHT:
+            composeViewCell(img, x, y)
+    viewCacheDirty.clear()
+
+# Puts the cache on screen. It wraps around, so that is up to four blts.
+def drawViewCache(world):
+    updateViewCache(world)
+    left, top = viewCacheAt
+    u = (left % WIDTH) * 16
+    v = (top % HEIGHT) * 16
+    w = WIDTH * 16
+    h = HEIGHT * 16
+    for sx, su, sw in ((0, u, w - u), (w - u, 0, u)):
+        if sw == 0:
+            continue
+        for sy, sv, sh in ((0, v, h - v), (h - v, 0, v)):
+            if sh == 0:
+                continue
+            pyxel.blt(sx, sy, BAKE_BANK, su, VIEW_CACHE_Y + sv, sw, sh)
+            if profiler.enabled:
+                profiler.count("blt")
+
+# Registers the sounds, and opens the window (only the once) if window is set.
+#   setup() does this, it only needs calling on its own for something that
+#   shows a world it didn't set up (like server.py's client).
+def setupPyxel(window=True):
+    global windowOpen
     # Register with Pyxel
-    pyxel.init(WIDTH * 16, HEIGHT * 16, caption="smolgame", palette=[0xff00e5, 0xaaa9ad, 0x5b676d, 0x1f262a, 0x9cff78, 0x44ff00, 0x2ca600, 0x7cff00, 0xff8b00, 0xff0086, 0x6f00ff, 0x0086ff, 0x00ff9a, 0x1f0000, 0x49afff, 0xe2e1ff], scale=4, fps=20)
+    if window and not windowOpen:
+        pyxel.init(WIDTH * 16, HEIGHT * 16, caption="smolgame", palette=[0xff00e5, 0xaaa9ad, 0x5b676d, 0x1f262a, 0x9cff78, 0x44ff00, 0x2ca600, 0x7cff00, 0xff8b00, 0xff0086, 0x6f00ff, 0x0086ff, 0x00ff9a, 0x1f0000, 0x49afff, 0xe2e1ff], scale=4, fps=FPS)
+        windowOpen = True
+        # Sounds registered before there was a window get loaded now
+        for s in sounds.values():
+            s.load()
 
     # Register sounds
     Sounded("collide", "c2c1", speed=4)
     Sounded("level", "c3e3g3c4c4")
     Sounded("bzzz", "c1c1c1c1c1c1c1", tone="t", speed=9)
 
+# This sets up the game: the basic turrets, and the local player unless
+#   localPlayer is False (a server's players all join from elsewhere, see
+#   server.py)
+def setup(world, localPlayer=True):
+    setupPyxel(not world.headless)
+
     # Register our player
-    player = Player("player")
-    entities.append(player)
+    if localPlayer:
+        player = Player("player")
+        world.addEntity(player)
 
-    st = StationaryTurret("turret", -1, -1, "N")
-    entities.append(st)
+    st = StationaryTurret("turret", -1, -1, "N", rng=world.rng)
+    world.addEntity(st)
 
-    st = StationaryTurret("turret", 16, 16, "S")
-    entities.append(st)
+    st = StationaryTurret("turret", 16, 16, "S", rng=world.rng)
+    world.addEntity(st)
 
-    st = StationaryTurret("turret", -1, 16, "W")
-    entities.append(st)
+    st = StationaryTurret("turret", -1, 16, "W", rng=world.rng)
+    world.addEntity(st)
 
-    st = StationaryTurret("turret", 16, -1, "E")
-    entities.append(st)
+    st = StationaryTurret("turret", 16, -1, "E", rng=world.rng)
+    world.addEntity(st)
 
-    mt = MovingTurret("turret", 8, 8, "N")
-    entities.append(mt)
+    mt = MovingTurret("turret", 8, 8, "N", chase=True, rng=world.rng)
+    world.addEntity(mt)
 
     #wa = Wall("wall", -1, 11)
-    #structures.append(wa)
+    #world.addStructure(wa)
     #wa = Wall("wall", -1, 12)
-    #structures.append(wa)
+    #world.addStructure(wa)
     #wa = Wall("wall", -1, 13)
-    #structures.append(wa)
+    #world.addStructure(wa)
     #wa = Wall("wall", -1, 14)
-    #structures.append(wa)
+    #world.addStructure(wa)
     #wa = Wall("wall", -1, 15)
-    #structures.append(wa)
+    #world.addStructure(wa)
 
 
     # Invalid texture test code
     #random = Entity("random", "random.png")
-    #entities.append(random)
+    #world.addEntity(random)
 
 def mapObjType(type, ct, cb, cl, cr):
     if type == "W":
@@ -576,29 +1764,68 @@ def mapObjType(type, ct, cb, cl, cr):
     if type[0] == "O":
         if "U" in type and ct:
             return Floor
-        if "D" in type and cl:
+        if "D" in type and cb:
             return Floor
         if "R" in type and cr:
             return Floor
-        if "L" in type and cb:
+        if "L" in type and cl:
             return Floor
         return Wall
     return None
 
+# Room templates out of their CSV files, keyed by file name, so a file is only
+#   ever read once. The files are laid out the way the room looks, a line per
+#   row of tiles, and get turned into a tuple of columns of cell codes so
+#   they are indexed [x][y] like everything else.
+roomTemplates = {}
+
+# Templates with their connections worked out, keyed by
+#   (file, ct, cb, cl, cr). Each entry is (roomData, stamp) where stamp is just
+#   the non-empty cells as (xL, yL, type), ready to be placed into the world.
+roomVariants = {}
+
+def loadRoomTemplate(csvFile):
+    template = roomTemplates.get(csvFile)
+    if template is None:
+        f = open(csvFile)
+        dat = f.read()
+        f.close()
+
+        lines = [x for x in dat.split("\n") if x.strip() != ""]
+        rows = [[entry.strip() for entry in line.split(",")] for line in lines]
+        template = tuple(zip(*rows))
+        roomTemplates[csvFile] = template
+    return template
+
+# Works out all 16 connection combos of a template in one go. mapObjType only
+#   gets called once per distinct cell code rather than once per cell.
+def resolveRoomTemplate(csvFile):
+    template = loadRoomTemplate(csvFile)
+    codes = set(entry for line in template for entry in line)
+    for ct in (False, True):
+        for cb in (False, True):
+            for cl in (False, True):
+                for cr in (False, True):
+                    types = {code: mapObjType(code,ct,cb,cl,cr) for code in codes}
+                    roomData = tuple(tuple(types[entry] for entry in line) for line in template)
+                    stamp = tuple((xL, yL, tile) for xL, line in enumerate(roomData) for yL, tile in enumerate(line) if tile is not None)
+                    roomVariants[(csvFile, ct, cb, cl, cr)] = (roomData, stamp)
+
+def roomVariant(csvFile, ct, cb, cl, cr):
+    key = (csvFile, bool(ct), bool(cb), bool(cl), bool(cr))
+    variant = roomVariants.get(key)
+    if variant is None:
+        resolveRoomTemplate(csvFile)
+        variant = roomVariants[key]
+    return variant
+
+# Returns the template as rows of Wall/Floor/None. This is shared between
+#   callers, so don't change it.
 def parseRoomCSV(csvFile, ct, cb, cl, cr):
-    f = open(csvFile)
-    dat = f.read()
-    f.close()
+    return roomVariant(csvFile, ct, cb, cl, cr)[0]
 
-    lines = [x for x in dat.split("\n") if x.strip() != ""]
-
-    roomData = []
-    for line in lines:
-        ld = []
-        for entry in line.split(","):
-            ld.append(mapObjType(entry,ct,cb,cl,cr))
-        roomData.append(ld)
-    return roomData
+# Size of a room tile, in tiles
+ROOM_TILES = 15
 
 class RoomTile():
     def __init__(self, ct, cb, cl, cr):
@@ -606,49 +1833,172 @@ class RoomTile():
         self.cl = cl
         self.cr = cr
         self.cb = cb
+        # What goes in it, see ROOM_CONTENTS
+        self.contents = 0
     # x and y are the room tile location, not the render tile. Room tiles are 15x15 the image tiles
-    def generateInWorld(self, x, y):
-        pass
+    #   Returns the structures it placed. rng rolls their looks, the world's
+    #   own if not given.
+    def generateInWorld(self, world, x, y, rng=None):
+        return []
+
+    # Places the cached template from csvFile into the world at room tile x,y
+    def stampInWorld(self, world, csvFile, x, y, rng=None):
+        if rng is None:
+            rng = world.rng
+        stamp = roomVariant(csvFile,self.ct,self.cb,self.cl,self.cr)[1]
+        placed = []
+        for xL, yL, tile in stamp:
+            if (tile == Floor):
+                tileObj = tile(name="floor", x=xL+x*ROOM_TILES, y=yL+y*ROOM_TILES, rng=rng)
+            else:
+                tileObj = tile(name="wall", x=xL+x*ROOM_TILES, y=yL+y*ROOM_TILES, rng=rng)
+            world.addStructure(tileObj)
+            placed.append(tileObj)
+        return placed
+
+    # Places the template from csvFile into a TileLevel at room tile x,y
+    def stampInLevel(self, csvFile, tileLevel, x, y):
+        tileLevel.stamp(roomTileArray(csvFile,self.ct,self.cb,self.cl,self.cr), x*ROOM_TILES, y*ROOM_TILES)
 
 # Generates a room
 class Room(RoomTile):
-    def generateInWorld(self, x, y):
-        roomData = parseRoomCSV("room.csv",self.ct,self.cb,self.cl,self.cr)
-        for xL in range(0,15):
-            for yL in range(0,15):
-                tile = roomData[xL][yL]
-                if (tile == Floor):
-                    tileObj = tile(name="floor", x=xL+x*15, y=yL+y*15)
-                    structures.append(tileObj)
-                elif (tile == Wall):
-                    tileObj = tile(name="wall", x=xL+x*15, y=yL+y*15)
-                    structures.append(tileObj)
+    csvFile = "room.csv"
+
+    def generateInWorld(self, world, x, y, rng=None):
+        return self.stampInWorld(world, self.csvFile, x, y, rng)
 
 # Generates a thin hallway between two or more rooms
 class Hallway(RoomTile):
-    def generateInWorld(self, x, y):
-        roomData = parseRoomCSV("hall.csv",self.ct,self.cb,self.cl,self.cr)
-        for xL in range(0,15):
-            for yL in range(0,15):
-                tile = roomData[xL][yL]
-                if (tile == Floor):
-                    tileObj = tile(name="floor", x=xL+x*15, y=yL+y*15)
-                    structures.append(tileObj)
-                elif (tile == Wall):
-                    tileObj = tile(name="wall", x=xL+x*15, y=yL+y*15)
-                    structures.append(tileObj)
-
-def basicWorldgen():
+    csvFile = "hall.csv"
+
+    def generateInWorld(self, world, x, y, rng=None):
+        return self.stampInWorld(world, self.csvFile, x, y, rng)
+
+# Tile types in a TileLevel
+TILE_EMPTY = 0
+TILE_FLOOR = 1
+TILE_FLOOR_BLIP = 2
+TILE_WALL = 3
+
+# Templates as uint8 TILE_* arrays for stamping into a TileLevel, keyed the
+#   same way as roomVariants
+roomArrays = {}
+
+def roomTileArray(csvFile, ct, cb, cl, cr):
+    key = (csvFile, bool(ct), bool(cb), bool(cl), bool(cr))
+    arr = roomArrays.get(key)
+    if arr is None:
+        roomData = roomVariant(csvFile, ct, cb, cl, cr)[0]
+        types = {None: TILE_EMPTY, Floor: TILE_FLOOR, Wall: TILE_WALL}
+        arr = np.array([[types[tile] for tile in line] for line in roomData], dtype=np.uint8)
+        roomArrays[key] = arr
+    return arr
+
+# An array-backed level. Rather than a Wall or Floor object per tile, the world
+#   is held in a few uint8 NumPy grids indexed [x, y]: the tile type, its flip
+#   bits and, for walls, which animation frame it starts on. Needs numpy.
+class TileLevel():
+    def __init__(self, width=GL_WIDTH, height=GL_HEIGHT):
+        self.width = width
+        self.height = height
+        self.tiles = np.zeros((width, height), dtype=np.uint8)
+        self.flips = np.zeros((width, height), dtype=np.uint8)
+        self.phases = np.zeros((width, height), dtype=np.uint8)
+        self.baked = False
+
+        self.wallTex = tuple(registerTexture("player/wall_{}".format(x), 16, "player/wall_{}.png".format(x)) for x in range(0,12))
+        self.floorTex = {
+            TILE_FLOOR: registerTexture("player/ground", 16, "player/ground.png"),
+            TILE_FLOOR_BLIP: registerTexture("player/ground_blip", 16, "player/ground_blip.png"),
+        }
+
+    # Copies the non-empty cells of a template array in with its corner at
+    #   tile x,y. Anything hanging off the edge of the level is cut off.
+    def stamp(self, template, x, y):
+        x0 = max(x, 0)
+        y0 = max(y, 0)
+        x1 = min(x + template.shape[0], self.width)
+        y1 = min(y + template.shape[1], self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        src = template[x0-x:x1-x, y0-y:y1-y]
+        dst = self.tiles[x0:x1, y0:y1]
+        mask = src != TILE_EMPTY
+        dst[mask] = src[mask]
+
+    # Rolls the random looks for every tile at once: the odd blip on the
+    #   floor, random flips, and where in its animation each wall starts
+    def decorate(self, rng):
+        shape = self.tiles.shape
+        floors = self.tiles == TILE_FLOOR
+        self.tiles[floors & (rng.integers(0, 9, shape) == 0)] = TILE_FLOOR_BLIP
+        self.flips[:] = rng.integers(0, 4, shape, dtype=np.uint8)
+        self.flips[self.tiles == TILE_EMPTY] = 0
+        self.phases[:] = rng.integers(0, 12, shape, dtype=np.uint8)
+        self.phases[self.tiles != TILE_WALL] = 0
+
+    # Same as allowAt(): True/False if there is something here, None if empty
+    def allowAt(self, x, y):
+        x = int(x)
+        y = int(y)
+        if x < 0 or x >= self.width or y < 0 or y >= self.height:
+            return None
+        tile = self.tiles[x, y]
+        if tile == TILE_EMPTY:
+            return None
+        return tile != TILE_WALL
+
+    # Draws the part of the level that is on screen. Floors are skipped once
+    #   they have been baked.
+    def draw(self, world):
+        left = int(-world.windowOffsetX)
+        top = int(-world.windowOffsetY)
+        x0 = max(left, 0)
+        y0 = max(top, 0)
+        x1 = min(left + WIDTH, self.width)
+        y1 = min(top + HEIGHT, self.height)
+        if x0 < x1 and y0 < y1:
+            tiles = self.tiles[x0:x1, y0:y1]
+            if self.baked:
+                xs, ys = np.nonzero(tiles == TILE_WALL)
+            else:
+                xs, ys = np.nonzero(tiles)
+            frame = world.animFrame(12, 0, 2)
+            for xL, yL in zip(xs.tolist(), ys.tolist()):
+                x = x0 + xL
+                y = y0 + yL
+                tile = tiles[xL, yL]
+                flip = int(self.flips[x, y])
+                if tile == TILE_WALL:
+                    h = self.wallTex[(frame + int(self.phases[x, y])) % 12]
+                    drawTexture(h, x + world.windowOffsetX, y + world.windowOffsetY, 0, flip)
+                else:
+                    drawTexture(self.floorTex[tile], x + world.windowOffsetX, y + world.windowOffsetY, flip=flip)
+
+    # Bakes every floor tile, see bakeLevel()
+    def bake(self):
+        xs, ys = np.nonzero((self.tiles == TILE_FLOOR) | (self.tiles == TILE_FLOOR_BLIP))
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            if x >= BAKE_TM_TILES * BAKE_TM_COLS or y >= BAKE_TM_TILES * BAKE_TM_ROWS:
+                continue
+            slot = bakeSlot(self.floorTex[self.tiles[x, y]], int(self.flips[x, y]))
+            if slot is None:
+                return
+            setBakedTile(x, y, slot)
+        self.baked = True
+
+def basicWorldgen(world):
     h = Hallway(True, True, True, True)
-    h.generateInWorld(0, 1)
+    h.generateInWorld(world, 0, 1)
     r = Room(True, True, True, True)
-    r.generateInWorld(0, 0)
+    r.generateInWorld(world, 0, 0)
     r = Room(True, True, True, True)
-    r.generateInWorld(1, 0)
-
-# Generate the world! You can use this to generate levels or whatever
-def worldgen(roomSetup):#
+    r.generateInWorld(world, 1, 0)
 
+# Lays out the rooms and the hallways between them on the 15x9 room grid.
+#   Returns a dict of room tile (x, y) to the Room or Hallway that goes there.
+#   Each Room gets one of the roomSetup values as its contents.
+def roomLayout(roomSetup, rng=random):
     rooms = roomSetup
     #rooms += [item for sublist in [[x[0] for y in range(x[1])] for x in roomSetup] for item in sublist]
     map = []
@@ -663,13 +2013,15 @@ def worldgen(roomSetup):#
     y = 1
     while len(rooms) > 1:
         map[x][y] = 1
-        roommap[x][y] = rooms.pop(random.randrange(0,len(rooms)))
-        n = random.randrange(1,5)
+        roommap[x][y] = rooms.pop(rng.randrange(0,len(rooms)))
+        n = rng.randrange(1,5)
         direction = 0
         not_this_way = 0
         while n > 0:
+            # All four ways, or the walk can never go down and runs out of
+            #   free room tiles in the top rows
             while direction == not_this_way:
-                direction = random.randrange(1,4)
+                direction = rng.randrange(1,5)
             if direction == 1: # Left
                 if x > 0:
                     not_this_way = 3
@@ -709,7 +2061,8 @@ def worldgen(roomSetup):#
             if roommap[x][y] == None or n > 1:
                 n = n - 1
     map[x][y] = 1
-    roommap[x][y] = rooms.pop(random.randrange(0,len(rooms)))
+    roommap[x][y] = rooms.pop(rng.randrange(0,len(rooms)))
+    layout = {}
     for x in range(0,15):
         for y in range(0,9):
             mxy = map[x][y]
@@ -732,56 +2085,627 @@ def worldgen(roomSetup):#
                 if map[x+1][y] != 0:
                     mxyr = True
             if mxy == 1:
-                roomobj = Room(mxyu,mxyd,mxyl,mxyr)
+                layout[(x, y)] = Room(mxyu,mxyd,mxyl,mxyr)
+                layout[(x, y)].contents = roommap[x][y]
             elif mxy == 2:
-                roomobj = Hallway(mxyu,mxyd,mxyl,mxyr)
-            roomobj.generateInWorld(x,y)
-
+                layout[(x, y)] = Hallway(mxyu,mxyd,mxyl,mxyr)
+    return layout
 
+# Generate the world! You can use this to generate levels or whatever
+#   With arrayLevel=True the level is built into a TileLevel (see World.level)
+#   instead of as a Wall/Floor object per tile. That needs numpy.
+#   With chunked=True only the layout is worked out now, and each room tile is
+#   built when a player gets near it (see ChunkMap).
+#   Every roll comes from rng, or from random.Random(seed) if only seed is
+#   given, or from world.rng if neither is. With a seed and
+#   cache=True the finished level is saved to LEVEL_CACHE_DIR, and the next
+#   worldgen with the same seed and roomSetup loads that instead, as long as
+#   the room templates haven't changed since (see loadLevelCache). That pays
+#   off for array levels, which load straight out of the file. Object levels
+#   still need every Wall and Floor built and added one by one, which is most
+#   of what generating them costs, so they only load about 1.4x faster.
+#   Returns the room layout (see roomLayout), or None if the level came out of
+#   the cache.
+def worldgen(world, roomSetup, arrayLevel=False, chunked=False, seed=None, rng=None, cache=False):#
+    if arrayLevel and np is None:
+        print("numpy is not installed, generating the level as objects instead")
+        arrayLevel = False
+    if rng is None:
+        rng = world.rng if seed is None else random.Random(seed)
+
+    cachePath = None
+    if cache and seed is not None and not chunked:
+        cachePath = levelCachePath(seed, roomSetup, arrayLevel)
+        if loadLevelCache(world, cachePath, arrayLevel):
+            return None
+
+    if arrayLevel:
+        world.level = TileLevel()
+    layout = roomLayout(roomSetup, rng)
+    if chunked and not arrayLevel:
+        world.chunks = ChunkMap(world, lambda x, y: layout.get((x, y)), rng.getrandbits(32))
+    else:
+        for (x, y), roomobj in layout.items():
+            if arrayLevel:
+                roomobj.stampInLevel(roomobj.csvFile, world.level, x, y)
+            else:
+                roomobj.generateInWorld(world, x, y, rng)
+        if arrayLevel:
+            world.level.decorate(np.random.default_rng(rng.getrandbits(32)))
+    # Rolled after the level, so what goes in the rooms doesn't change them
+    turrets = roomTurrets(layout, rng)
+    placeTurrets(world, turrets)
+    if world.chunks is not None:
+        world.chunks.stream()
+    if cachePath is not None:
+        saveLevelCache(world, cachePath, turrets)
+    return layout
+
+# What the values in a roomSetup put in their room: nothing, a turret that
+#   stays put, or one that moves, chasing any player that comes near. Turrets
+#   go in the middle of the room.
+ROOM_CONTENTS = {0: None, 1: StationaryTurret, 2: MovingTurret}
+
+# Works out the turrets that go in the rooms of a layout, as a list of
+#   (x, y, contents, dir)
+def roomTurrets(layout, rng=random):
+    turrets = []
+    for (x, y), roomobj in layout.items():
+        if ROOM_CONTENTS.get(roomobj.contents) is not None:
+            turrets.append((x*ROOM_TILES + 7, y*ROOM_TILES + 7, roomobj.contents, rng.choice("NSEW")))
+    return turrets
+
+def placeTurrets(world, turrets):
+    for x, y, contents, dir in turrets:
+        kind = ROOM_CONTENTS[contents]
+        if kind is MovingTurret:
+            world.addEntity(MovingTurret("turret", x, y, dir, chase=True, rng=world.rng))
+        else:
+            world.addEntity(kind("turret", x, y, dir, rng=world.rng))
+
+# Saved levels. A file is a header, then the TILE_* of every tile, then the
+#   flip of every tile, then the animation phase of every tile (each one byte
+#   per tile, column by column, same as TileLevel's arrays), then the turrets.
+#   The header says which version of the format the file is, and which room
+#   templates it was built from (see templatesHash), and a file only gets
+#   loaded if both still match. LEVEL_CACHE_VERSION needs bumping whenever
+#   the layout of the file, or what worldgen builds for a seed, changes.
+LEVEL_CACHE_DIR = "levelcache"
+LEVEL_CACHE_MAGIC = b"SMLV"
+LEVEL_CACHE_VERSION = 9
+# magic, version, templates hash, width, height, turret count
+LEVEL_CACHE_HEADER = struct.Struct("<4sHIHHH")
+# x, y, contents, dir
+LEVEL_CACHE_TURRET = struct.Struct("<hhBc")
+
+def levelCachePath(seed, roomSetup, arrayLevel):
+    setupHash = zlib.crc32(",".join(str(x) for x in roomSetup).encode())
+    kind = "array" if arrayLevel else "objects"
+    return os.path.join(LEVEL_CACHE_DIR, "level_{}_{:08x}_{}.bin".format(seed, setupHash, kind))
+
+# A hash of the room templates worldgen builds levels out of, as they are
+#   loaded (see loadRoomTemplate)
+def templatesHash():
+    h = 0
+    for csvFile in (Room.csvFile, Hallway.csvFile):
+        h = zlib.crc32(repr(loadRoomTemplate(csvFile)).encode(), h)
+    return h
+
+# Returns world's level as (width, height, tiles, flips, phases), the last
+#   three as bytes laid out the way the cache file has them
+def levelGrids(world):
+    level = world.level
+    if level is not None:
+        return level.width, level.height, level.tiles.tobytes(), level.flips.tobytes(), level.phases.tobytes()
+    width = max([s.x + 1 for s in world.structures] + [0])
+    height = max([s.y + 1 for s in world.structures] + [0])
+    tiles = bytearray(width * height)
+    flips = bytearray(width * height)
+    phases = bytearray(width * height)
+    blip = textureHandles.get(("player/ground_blip.png",))
+    for s in world.structures:
+        i = s.x * height + s.y
+        if s.x < 0 or s.y < 0 or tiles[i] != TILE_EMPTY:
+            continue
+        if type(s) is Wall:
+            tiles[i] = TILE_WALL
+            phases[i] = s.phase
+        elif type(s) is Floor:
+            tiles[i] = TILE_FLOOR_BLIP if s.tex == blip else TILE_FLOOR
+        else:
+            continue
+        flips[i] = s.flip
+    return width, height, bytes(tiles), bytes(flips), bytes(phases)
+
+def saveLevelCache(world, filename, turrets):
+    width, height, tiles, flips, phases = levelGrids(world)
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    # Written next to it and moved over, so a half written file is never seen
+    tmp = filename + ".tmp"
+    f = open(tmp, "wb")
+    f.write(LEVEL_CACHE_HEADER.pack(LEVEL_CACHE_MAGIC, LEVEL_CACHE_VERSION, templatesHash(), width, height, len(turrets)))
+    f.write(tiles)
+    f.write(flips)
+    f.write(phases)
+    for x, y, contents, dir in turrets:
+        f.write(LEVEL_CACHE_TURRET.pack(x, y, contents, dir.encode()))
+    f.close()
+    os.replace(tmp, filename)
+
+# Builds the Wall and Floor objects for grids laid out the way levelGrids()
+#   returns them
+def placeGrids(world, width, height, tiles, flips, phases):
+    floorFiles = {TILE_FLOOR: "player/ground.png", TILE_FLOOR_BLIP: "player/ground_blip.png"}
+    for i, tile in enumerate(tiles):
+        if tile == TILE_EMPTY:
+            continue
+        x, y = divmod(i, height)
+        if tile == TILE_WALL:
+            world.addStructure(Wall("wall", x, y, phase=phases[i], flip=flips[i]))
+        else:
+            world.addStructure(Floor("floor", x, y, texture=floorFiles[tile], flip=flips[i]))
+
+# Loads a level saved by saveLevelCache(). The file is memory mapped, so an
+#   array level's tiles are read straight out of it, and only the parts that
+#   get looked at ever get read in. Returns False if there is no usable file,
+#   including one saved by another version or from other room templates.
+def loadLevelCache(world, filename, arrayLevel):
+    try:
+        f = open(filename, "rb")
+    except OSError:
+        return False
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    except ValueError:
+        return False
+    finally:
+        f.close()
+    if len(data) < LEVEL_CACHE_HEADER.size:
+        return False
+    magic, version, templates, width, height, turretCount = LEVEL_CACHE_HEADER.unpack_from(data, 0)
+    size = width * height
+    turretsAt = LEVEL_CACHE_HEADER.size + size * 3
+    if magic != LEVEL_CACHE_MAGIC or version != LEVEL_CACHE_VERSION:
+        return False
+    if templates != templatesHash():
+        return False
+    if len(data) != turretsAt + turretCount * LEVEL_CACHE_TURRET.size:
+        return False
 
-# This is called by Pyxel every tick, and handles all game inputs
-def update():
+    tilesAt = LEVEL_CACHE_HEADER.size
+    if arrayLevel:
+        level = TileLevel(width, height)
+        world.level = level
+        level.tiles = np.frombuffer(data, np.uint8, size, tilesAt).reshape(width, height)
+        level.flips = np.frombuffer(data, np.uint8, size, tilesAt + size).reshape(width, height)
+        level.phases = np.frombuffer(data, np.uint8, size, tilesAt + size*2).reshape(width, height)
+    else:
+        placeGrids(world, width, height, data[tilesAt:tilesAt + size],
+            data[tilesAt + size:tilesAt + size*2], data[tilesAt + size*2:turretsAt])
+
+    turrets = []
+    for i in range(turretCount):
+        x, y, contents, dir = LEVEL_CACHE_TURRET.unpack_from(data, turretsAt + i * LEVEL_CACHE_TURRET.size)
+        turrets.append((x, y, contents, dir.decode()))
+    placeTurrets(world, turrets)
+    return True
 
-    # Quit if Q
-    if pyxel.btn(pyxel.KEY_Q):
-        pyxel.quit()
 
-    # Play a sound if Space
-    if pyxel.btn(pyxel.KEY_SPACE):
-        sounds["level"].play(1)
 
-    # Tick all entites and structures. The player movement is included randomly
-    #   somewhere in this list but you can do a list comprehension to make it
-    #   go first or last if you want (examples provided with no warranty)
-    # for x in [x for x in entities if x is Player]
-    # for x in [x for x in entities if x is not Player]
+# How far around a player, in room tiles, chunks get built, and how far away
+#   they have to be before they are thrown away again. The gap between the two
+#   stops a chunk being built and thrown away over and over by someone pacing
+#   along its edge.
+CHUNK_LOAD_RADIUS = 1
+CHUNK_KEEP_RADIUS = 2
+
+# A level built one room tile ("chunk") at a time. roomAt(x, y) says what
+#   goes at room tile x,y (a RoomTile, or None for nothing), and each chunk
+#   rolls its looks from its own RNG seeded off seed and x,y, so a chunk comes
+#   out the same whenever it gets built. That means far away chunks can just
+#   be thrown away and built again later, and only the chunks near a player
+#   are ever in the world's structures.
+class ChunkMap():
+    def __init__(self, world, roomAt, seed):
+        self.world = world
+        self.roomAt = roomAt
+        self.seed = seed
+        # Built chunks, by room tile, holding the structures they placed
+        self.active = {}
+
+    def chunkRng(self, x, y):
+        return random.Random("{}/{}/{}".format(self.seed, x, y))
+
+    def load(self, x, y):
+        room = self.roomAt(x, y)
+        placed = []
+        if room is not None:
+            placed = room.generateInWorld(self.world, x, y, self.chunkRng(x, y))
+        self.active[(x, y)] = placed
+        if profiler.enabled:
+            profiler.count("chunksLoaded")
+
+    def unload(self, key):
+        self.world.removeStructures(self.active.pop(key))
+        if profiler.enabled:
+            profiler.count("chunksUnloaded")
+
+    # Builds the chunks around every player and throws away the ones no player
+    #   is near anymore
+    def stream(self):
+        players = [(int(p.x // ROOM_TILES), int(p.y // ROOM_TILES)) for p in self.world.entitiesOfType(Player)]
+        for cx, cy in players:
+            for x in range(cx - CHUNK_LOAD_RADIUS, cx + CHUNK_LOAD_RADIUS + 1):
+                for y in range(cy - CHUNK_LOAD_RADIUS, cy + CHUNK_LOAD_RADIUS + 1):
+                    if (x, y) not in self.active:
+                        self.load(x, y)
+        far = [key for key in self.active if all(
+            max(abs(key[0] - cx), abs(key[1] - cy)) > CHUNK_KEEP_RADIUS for cx, cy in players)]
+        for key in far:
+            self.unload(key)
+
+# Chance that an endless level room tile is a room rather than a hallway, and
+#   that two neighbouring room tiles are joined up
+ENDLESS_ROOMS = 0.35
+ENDLESS_JOINS = 0.6
+
+# Returns a roomAt(x, y) for a ChunkMap that goes on forever. Every room tile
+#   has something on it, and whether it is a room and which of its sides are
+#   open is rolled from seed and where it is, so neighbours always agree on
+#   the side they share.
+def endlessRoomAt(seed):
+    def joined(x, y, side):
+        return random.Random("{}/join/{}/{}/{}".format(seed, x, y, side)).random() < ENDLESS_JOINS
+
+    def roomAt(x, y):
+        up = joined(x, y - 1, "D")
+        down = joined(x, y, "D")
+        left = joined(x - 1, y, "R")
+        right = joined(x, y, "R")
+        if (x, y) == (0, 0) or random.Random("{}/room/{}/{}".format(seed, x, y)).random() < ENDLESS_ROOMS:
+            return Room(up, down, left, right)
+        return Hallway(up, down, left, right)
+    return roomAt
+
+# Generates a level with no edges, built around the player as they go
+def endlessWorldgen(world, seed=None):
+    if seed is None:
+        seed = world.rng.getrandbits(32)
+    world.bounded = False
+    world.chunks = ChunkMap(world, endlessRoomAt(seed), seed)
+    world.chunks.stream()
+
+# Times the phases of update() and draw() and counts what they do. It is off
+#   until enabled (--profile, or F1 for the overlay), and costs next to nothing
+#   while off. Each frame, meaning one update() and the draw()s after it, can
+#   be shown on screen and/or written to a trace file.
+class Profiler():
+    def __init__(self):
+        self.enabled = False
+        self.overlay = False
+        # Set to stay enabled with the overlay down, for --profile and traces
+        self.always = False
+        self.trace = None
+        self.traceCSV = False
+        self.frame = 0
+        # Seconds spent in each phase, and counters, for the current frame
+        self.times = {}
+        self.counts = {}
+        # The same for the last finished frame, which is what the overlay shows
+        self.lastTimes = {}
+        self.lastCounts = {}
+        # Per entity class phase names, so they aren't rebuilt every tick
+        self.classKeys = {}
+        self.toggleHeld = False
+
+    # Writes every frame to filename from now on. Files ending in .csv get one
+    #   "frame,metric,value" row per number, anything else gets one JSON
+    #   object per frame.
+    def openTrace(self, filename):
+        self.enabled = True
+        self.always = True
+        self.trace = open(filename, "w")
+        self.traceCSV = filename.endswith(".csv")
+        if self.traceCSV:
+            self.trace.write("frame,metric,value\n")
+        atexit.register(self.close)
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    # Flips the overlay on and off when `held` goes down, like a key would.
+    #   Taking the overlay down stops profiling too, unless always is set.
+    def toggle(self, held):
+        if held and not self.toggleHeld:
+            self.overlay = not self.overlay
+            self.enabled = self.overlay or self.always
+            if not self.enabled:
+                self.times = {}
+                self.counts = {}
+        self.toggleHeld = held
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    # Adds the time since `since` (from time.perf_counter()) onto phase name
+    def lap(self, name, since):
+        now = time.perf_counter()
+        self.times[name] = self.times.get(name, 0) + now - since
+        return now
+
+    def classKey(self, prefix, cls):
+        key = self.classKeys.get((prefix, cls))
+        if key is None:
+            key = prefix + "." + cls.__name__
+            self.classKeys[(prefix, cls)] = key
+        return key
+
+    # Closes off the current frame: writes it to the trace and keeps it for
+    #   the overlay
+    def endFrame(self, tick):
+        if self.trace is not None and (self.times or self.counts):
+            if self.traceCSV:
+                for name, value in self.times.items():
+                    self.trace.write("{},{},{:.7f}\n".format(self.frame, name, value))
+                for name, value in self.counts.items():
+                    self.trace.write("{},{},{}\n".format(self.frame, name, value))
+            else:
+                self.trace.write(json.dumps({"frame": self.frame, "tick": tick, "times": self.times, "counts": self.counts}) + "\n")
+        self.lastTimes = self.times
+        self.lastCounts = self.counts
+        self.times = {}
+        self.counts = {}
+        self.frame += 1
+
+    def drawOverlay(self):
+        t = self.lastTimes
+        c = self.lastCounts
+        lines = [
+            "upd {:5.2f}ms drw {:5.2f}ms".format(t.get("update", 0)*1000, t.get("draw", 0)*1000),
+            "blt {} bltm {} lazers {}".format(c.get("blt", 0), c.get("bltm", 0), c.get("lazers", 0)),
+            "canGo {} ticked {}/{} drawn {}".format(c.get("canGo", 0), c.get("actorsTicked", 0), c.get("actorsAwake", 0), c.get("structuresDrawn", 0)),
+        ]
+        # The three slowest entity classes
+        classes = sorted((k for k in t if k.startswith("update.") and k[7].isupper()), key=lambda k: -t[k])
+        for k in classes[:3]:
+            lines.append("{} {:5.2f}ms".format(k[7:], t[k]*1000))
+        pyxel.rect(0, 0, 4*max(len(line) for line in lines) + 1, len(lines)*7 + 2, 3)
+        for i, line in enumerate(lines):
+            pyxel.text(1, 1 + i*7, line, 15)
+
+profiler = Profiler()
 
-    # Clear all lazers
-    lazers.clear()
+# This is called by Pyxel every tick, and handles all game inputs
+def update():
+    world.update()
+    if world.quitRequested and not world.headless:
+        pyxel.quit()
 
-    for x in structures:
-        x.update()
-    for x in entities:
-        x.update()
+# How many tiles past each edge of the screen still get handed to draw().
+#   Anything further out than this is skipped without being looked at.
+CULL_MARGIN = 1
+
+# Returns the tile bounds (left, top, right, bottom) of what draw() looks at.
+#   Right and bottom are exclusive.
+def viewBounds(world):
+    left = int(-world.windowOffsetX) - CULL_MARGIN
+    top = int(-world.windowOffsetY) - CULL_MARGIN
+    return left, top, left + WIDTH + CULL_MARGIN*2, top + HEIGHT + CULL_MARGIN*2
+
+# Yields only the structures in view, straight out of the tile index, so this
+#   costs the same no matter how big the level is
+def visibleStructures(world):
+    left, top, right, bottom = viewBounds(world)
+    for x in range(left, right):
+        for y in range(top, bottom):
+            cell = world.structureMap.get((x, y))
+            if cell:
+                yield from cell
+
+# Yields the things in objs (entities, lazers) that are in view
+def visibleObjects(world, objs):
+    left, top, right, bottom = viewBounds(world)
+    for o in objs:
+        if left <= o.x < right and top <= o.y < bottom:
+            yield o
+
+# Fog of war: with useFog set, only what a player can see from where they
+#   stand (up to PLAYER_SIGHT tiles away) gets shown, the rest of the screen
+#   is painted over
+PLAYER_SIGHT = 8
+useFog = False
+
+# Paints over every tile on screen no player can see, a run of them at a time
+def drawFog(world):
+    visible = set()
+    for p in world.entitiesOfType(Player):
+        visible |= world.sight.visibleFrom(p.x, p.y, PLAYER_SIGHT)
+    left = int(-world.windowOffsetX)
+    top = int(-world.windowOffsetY)
+    for sY in range(0, HEIGHT):
+        y = top + sY
+        runStart = None
+        for sX in range(0, WIDTH + 1):
+            hidden = sX < WIDTH and (left + sX, y) not in visible
+            if hidden and runStart is None:
+                runStart = sX
+            elif not hidden and runStart is not None:
+                pyxel.rect(runStart*16, sY*16, (sX - runStart)*16, 16, 3)
+                runStart = None
 
 # This is called by Pyxel every time the screen needs a redraw, which can be
-#   more than once per tick, but really depends on the FPS?
+#   more than once per tick, but really depends on the FPS? Draws `world`.
 def draw():
-    # Clear the screen
-    pyxel.cls(col=3)
-    for x in structures:
-        x.draw()
-    for x in lazers:
-        x.draw()
-    for x in entities:
-        x.draw()
-
-# This is where the game setup logic is
-def run():
-    setup()
-    basicWorldgen()
-    #worldgen([0,0,0,0,0,0,0,0,0,0,0,0])
+    if profiler.enabled:
+        started = t = time.perf_counter()
+    # The cached background covers the whole screen, so it doubles as the clear
+    if world.baked and useViewCache:
+        drawViewCache(world)
+    elif world.baked:
+        pyxel.cls(col=3)
+        drawBakedLevel(world)
+    else:
+        pyxel.cls(col=3)
+    if world.level is not None:
+        world.level.draw(world)
+    if profiler.enabled:
+        t = profiler.lap("draw.level", t)
+    drawn = 0
+    for x in visibleStructures(world):
+        if not x.baked:
+            x.draw(world)
+            drawn += 1
+    if profiler.enabled:
+        t = profiler.lap("draw.structures", t)
+        profiler.count("structuresDrawn", drawn)
+    # Beams clip themselves to the screen, as one can cross it from a turret
+    #   that is off screen
+    for x in world.lazers:
+        x.draw(world)
+    if profiler.enabled:
+        t = profiler.lap("draw.lazers", t)
+    for x in visibleObjects(world, world.entities):
+        x.draw(world)
+    if profiler.enabled:
+        t = profiler.lap("draw.entities", t)
+    if useFog:
+        drawFog(world)
+        if profiler.enabled:
+            profiler.lap("draw.fog", t)
+    if profiler.enabled:
+        profiler.lap("draw", started)
+        if profiler.overlay:
+            profiler.drawOverlay()
+
+# Swaps the world being shown for a fresh, empty one and returns it. The old
+#   world's input carries over. Registered textures and sounds stay.
+def resetWorld():
+    global world
+    world = World(world.input)
+    invalidateViewCache()
+    return world
+
+# Runs the game with no window, no sound and no pyxel at all, ticking as fast
+#   as the CPU allows. worldFn builds the level, inputs is what the player
+#   "presses" (nothing by default), and seed seeds the world's rng if given.
+#   Each Simulation has a headless World of its own (sim.world), separate
+#   from the shown one, so several can be run side by side.
+#
+#   sim = Simulation(seed=1)
+#   sim.step(10000)
+class Simulation():
+    def __init__(self, worldFn=basicWorldgen, inputs=None, seed=None):
+        self.world = World(inputs, seed, headless=True)
+        setup(self.world)
+        worldFn(self.world)
+        self.ticks = 0
+
+    # Runs n ticks, or fewer if the game asked to quit. Returns how many ran.
+    def step(self, n=1):
+        ran = 0
+        while ran < n and not self.world.quitRequested:
+            self.world.update()
+            ran += 1
+        self.ticks += ran
+        return ran
+
+# This is where the game setup logic is. inputs is the keyboard unless given,
+#   and seed seeds the world's rng if given.
+def run(worldFn=basicWorldgen, inputs=None, seed=None):
+    if pyxel is None:
+        print("CRITICAL FAIL! pyxel is not installed, only headless runs work.")
+        exit(1)
+    world.input = inputs
+    if world.input is None:
+        world.input = PyxelInput()
+    if seed is not None:
+        world.rng.seed(seed)
+    # The atlas gets loaded into the window's image maps, so that opens first
+    setupPyxel()
+    loadAtlas()
+    setup(world)
+    worldFn(world)
+    #worldgen(world, [0,0,0,0,0,0,0,0,0,0,0,0])
+    bakeLevel(world)
     pyxel.run(update, draw)
 
-# This is the entry point for our file.
-run()
+# Soak test: runs a headless simulation for a number of ticks and prints how
+#   fast it went
+def soak(ticks, seed=None, worldFn=basicWorldgen, inputs=None):
+    sim = Simulation(worldFn=worldFn, inputs=inputs, seed=seed)
+    start = time.perf_counter()
+    ran = sim.step(ticks)
+    elapsed = time.perf_counter() - start
+    print("{} ticks in {:.3f}s, {:.0f} ticks/s".format(ran, elapsed, ran / max(elapsed, 1e-9)))
+
+# The worlds a game can be started in, by the name recordings know them by
+WORLD_FNS = {"basic": basicWorldgen, "endless": endlessWorldgen}
+
+# Plays a recording back headless, as fast as it goes, and says whether it
+#   came out the same. Returns True if it did.
+def replay(inputs):
+    sim = Simulation(worldFn=WORLD_FNS[inputs.worldName], inputs=inputs, seed=inputs.seed)
+    start = time.perf_counter()
+    ran = sim.step(len(inputs.masks))
+    elapsed = time.perf_counter() - start
+    print("{} ticks in {:.3f}s, {:.0f} ticks/s".format(ran, elapsed, ran / max(elapsed, 1e-9)))
+    if inputs.diverged is not None:
+        print("Replay diverged at tick {}".format(inputs.diverged))
+        return False
+    print("Replay matched on all {} ticks".format(inputs.checked))
+    return True
+
+# This is the entry point for our file. It only runs the game when started
+#   directly, so other scripts (like bench.py) can import it.
+#   Pass --headless TICKS to soak test without a window instead. --record FILE
+#   saves a session, and --replay FILE plays it back headless to check (and
+#   profile, with --trace) it, or in a window with --watch.
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="smolgame")
+    parser.add_argument("--headless", type=int, metavar="TICKS", help="run this many ticks without a window and report the speed")
+    parser.add_argument("--seed", type=int, help="seed for random")
+    parser.add_argument("--endless", action="store_true", help="play an endless level, built as you go")
+    parser.add_argument("--fog", action="store_true", help="only show what the player can see")
+    parser.add_argument("--profile", action="store_true", help="start with the profiling overlay up (F1 toggles it)")
+    parser.add_argument("--trace", metavar="FILE", help="write per-frame timings and counters to FILE (.csv or .jsonl)")
+    parser.add_argument("--record", metavar="FILE", help="record the keys pressed and the seed to FILE")
+    parser.add_argument("--replay", metavar="FILE", help="play back a recording headless and check it comes out the same")
+    parser.add_argument("--watch", action="store_true", help="with --replay, show the replay in a window instead")
+    args = parser.parse_args()
+    if args.trace:
+        profiler.openTrace(args.trace)
+    if args.profile:
+        profiler.always = True
+        profiler.toggle(True)
+    useFog = args.fog
+    worldName = "basic"
+    if args.endless:
+        worldName = "endless"
+    worldFn = WORLD_FNS[worldName]
+
+    if args.replay:
+        inputs = loadReplay(args.replay)
+        if inputs is None or inputs.worldName not in WORLD_FNS:
+            print("CRITICAL FAIL! {} is not a recording this version can play.".format(args.replay))
+            exit(1)
+        if args.watch:
+            run(WORLD_FNS[inputs.worldName], inputs, inputs.seed)
+        elif not replay(inputs):
+            exit(1)
+        exit(0)
+
+    # Recordings need to know the seed, so one gets picked if none was given
+    seed = args.seed
+    inputs = None
+    if args.record:
+        if seed is None:
+            seed = random.getrandbits(32)
+        inputs = RecordingInput(NullInput() if args.headless is not None else PyxelInput(), seed, worldName)
+        atexit.register(inputs.save, args.record)
+    if args.headless is not None:
+        soak(args.headless, seed, worldFn, inputs)
+    else:
+        run(worldFn, inputs, seed)
@@ -0,0 +1,384 @@
+#!/usr/bin/python3
+
+# Runs one game for several clients at once. The server owns the world and
+#   ticks it headless; clients send it the keys they hold and get back what
+#   changed every tick, and draw the game from that. Everything goes over TCP
+#   as one JSON message per line.
+#
+#   python3 server.py                           serves the basic level on port 7420
+#   python3 server.py --rooms 12 --seed 5       serves a seeded worldgen level
+#   python3 server.py --connect localhost       plays on a server (needs pyxel)
+#   python3 server.py --connect localhost --watch   just watches
+#   python3 server.py --loadtest 10,100,500     how many clients one server takes
+#
+# A client starts by sending {"type": "join", "play": true/false}. It gets
+#   back a hello with the level (sent once, as levelGrids() packs it), the
+#   entity id of its player if it is playing, and the state of everything.
+#   After that it gets a tick message every tick:
+#
+#   {"type": "tick", "tick": 12, "sent": <time>,
+#    "entities": {"3": ["turret", x, y, dir, charge], ...},   new or changed
+#    "gone": ["5"],                                           removed
+#    "beams": [[x, y, dir, segments], ...],                   only if changed
+#    "camera": [x, y]}                                        only if changed
+#
+#   and sends {"type": "input", "keys": ["up", ...]} whenever what it holds
+#   changes. Only the movement keys are listened to.
+
+import sys, os, time, json, random, socket, asyncio, argparse, threading, queue, subprocess
+
+import main
+from batchgen import packGrid, unpackGrid
+
+DEFAULT_PORT = 7420
+PROTOCOL_VERSION = 1
+
+# Keys a remote player can hold
+MOVE_KEYS = ("up", "down", "left", "right")
+
+# A client whose unsent messages pile up past this many bytes has stopped
+#   keeping up, and gets dropped instead of buffered for without end
+MAX_BACKLOG = 1 << 20
+
+# What goes over the wire for each kind of entity, and back
+ENTITY_KINDS = {main.Player: "player", main.StationaryTurret: "turret", main.MovingTurret: "moving"}
+KIND_CLASSES = {kind: cls for cls, kind in ENTITY_KINDS.items()}
+
+def encode(message):
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode()
+
+# Held keys, as last sent by a remote player
+class RemoteInput(main.NullInput):
+    def __init__(self):
+        self.held = ()
+
+    def btn(self, key):
+        return key in self.held
+
+class Client():
+    def __init__(self, writer, player=None):
+        self.writer = writer
+        self.player = player
+
+    # Queues up a message, or drops the client if it has fallen too far behind.
+    #   Returns False once the client is gone.
+    def send(self, line):
+        if self.writer.is_closing():
+            return False
+        if self.writer.transport.get_write_buffer_size() > MAX_BACKLOG:
+            self.writer.close()
+            return False
+        self.writer.write(line)
+        return True
+
+class GameServer():
+    def __init__(self, worldFn=main.basicWorldgen, seed=None, fps=main.FPS):
+        self.world = main.World(seed=seed, headless=True)
+        main.setup(self.world, localPlayer=False)
+        worldFn(self.world)
+        if self.world.chunks is not None:
+            raise ValueError("levels built as they go can't be served, the level is only sent once")
+        self.fps = fps
+        self.clients = []
+        # Wire ids for entities, and what was last sent for each
+        self.ids = {}
+        self.nextId = 1
+        self.sent = {}
+        self.sentBeams = []
+        self.sentCamera = None
+        self.level = self.levelMessage()
+        self.delta()
+
+    def levelMessage(self):
+        width, height, tiles, flips, phases = main.levelGrids(self.world)
+        return {"width": width, "height": height, "tiles": packGrid(tiles), "flips": packGrid(flips), "phases": packGrid(phases)}
+
+    def entityId(self, e):
+        id = self.ids.get(e)
+        if id is None:
+            id = str(self.nextId)
+            self.nextId += 1
+            self.ids[e] = id
+        return id
+
+    # Works out what changed since the last call, and remembers it as sent
+    def delta(self):
+        world = self.world
+        message = {"type": "tick", "tick": world.tick, "sent": time.time()}
+        entities = {}
+        now = {}
+        for e in world.entities:
+            kind = ENTITY_KINDS.get(type(e))
+            if kind is None:
+                continue
+            id = self.entityId(e)
+            state = [kind, e.x, e.y, e.dir, getattr(e, "charge", 0)]
+            now[id] = state
+            if self.sent.get(id) != state:
+                entities[id] = state
+        gone = [id for id in self.sent if id not in now]
+        if gone:
+            goneIds = set(gone)
+            for e in [e for e, id in self.ids.items() if id in goneIds]:
+                del self.ids[e]
+        beams = [[b.x, b.y, b.dir, b.segments] for b in world.lazers]
+        camera = [world.windowOffsetX, world.windowOffsetY]
+        message["entities"] = entities
+        if gone:
+            message["gone"] = gone
+        if beams != self.sentBeams:
+            message["beams"] = beams
+        if camera != self.sentCamera:
+            message["camera"] = camera
+        self.sent = now
+        self.sentBeams = beams
+        self.sentCamera = camera
+        return message
+
+    # Everything as last sent, for a client that is just joining
+    def snapshot(self):
+        return {"type": "tick", "tick": self.world.tick, "sent": time.time(), "entities": dict(self.sent),
+            "beams": self.sentBeams, "camera": self.sentCamera}
+
+    def broadcast(self, line):
+        self.clients = [c for c in self.clients if c.send(line)]
+
+    async def handle(self, reader, writer):
+        client = None
+        try:
+            join = json.loads(await reader.readline() or "{}")
+            if join.get("type") != "join":
+                return
+            player = None
+            if join.get("play"):
+                player = main.Player("player", input=RemoteInput())
+                self.world.addEntity(player)
+            client = Client(writer, player)
+            hello = {"type": "hello", "version": PROTOCOL_VERSION, "fps": self.fps,
+                "you": self.entityId(player) if player is not None else None,
+                "level": self.level, "state": self.snapshot()}
+            writer.write(encode(hello))
+            self.clients.append(client)
+            async for line in reader:
+                message = json.loads(line)
+                if message.get("type") == "input" and player is not None:
+                    player.input.held = tuple(k for k in message.get("keys", ()) if k in MOVE_KEYS)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            if client is not None:
+                if client in self.clients:
+                    self.clients.remove(client)
+                if client.player is not None:
+                    self.world.removeEntity(client.player)
+                    # The hello gave it an id. If it leaves before a tick
+                    #   sends it, delta() never sees it go, so drop it here.
+                    self.ids.pop(client.player, None)
+            writer.close()
+
+    async def tickLoop(self, ticks=None):
+        loop = asyncio.get_running_loop()
+        step = 1 / self.fps
+        due = loop.time()
+        ran = 0
+        while ticks is None or ran < ticks:
+            self.world.update()
+            self.broadcast(encode(self.delta()))
+            ran += 1
+            due += step
+            # Don't try to catch up on more than a second's worth of ticks
+            due = max(due, loop.time() - 1)
+            await asyncio.sleep(max(0, due - loop.time()))
+
+    async def serve(self, host, port, ticks=None):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await self.tickLoop(ticks)
+
+# Keeps a world in step with what a server sends, so it can be drawn
+class View():
+    def __init__(self, world, hello):
+        self.world = world
+        self.you = hello["you"]
+        self.entities = {}
+        level = hello["level"]
+        main.placeGrids(world, level["width"], level["height"], unpackGrid(level["tiles"]),
+            unpackGrid(level["flips"]), unpackGrid(level["phases"]))
+        self.apply(hello["state"])
+
+    def apply(self, message):
+        world = self.world
+        world.tick = message["tick"]
+        for id, (kind, x, y, dir, charge) in message["entities"].items():
+            e = self.entities.get(id)
+            if e is None:
+                e = KIND_CLASSES[kind](kind, x, y)
+                self.entities[id] = e
+                world.addEntity(e)
+            else:
+                world.moveEntity(e, x, y)
+            e.dir = dir
+            if hasattr(e, "charge"):
+                e.charge = charge
+        for id in message.get("gone", ()):
+            world.removeEntity(self.entities.pop(id))
+        if "beams" in message:
+            world.lazers = []
+            for x, y, dir, segments in message["beams"]:
+                beam = main.Beam(world, 0, x, y, dir)
+                beam.segments = segments
+                world.lazers.append(beam)
+        if "camera" in message:
+            world.windowOffsetX, world.windowOffsetY = message["camera"]
+        # A player keeps the camera on themselves
+        you = self.entities.get(self.you)
+        if you is not None:
+            world.windowOffsetX = int(main.WIDTH/2) - you.x
+            world.windowOffsetY = int(main.HEIGHT/2) - you.y
+
+# Plays (or watches) on a server in a pyxel window. The connection is read on
+#   a thread of its own, and whatever came in gets applied once per frame.
+def runClient(host, port, play):
+    if main.pyxel is None:
+        print("CRITICAL FAIL! pyxel is not installed, the client needs it to show the game.")
+        sys.exit(1)
+    sock = socket.create_connection((host, port))
+    sock.sendall(encode({"type": "join", "play": play}))
+    lines = sock.makefile("rb")
+    hello = json.loads(lines.readline())
+
+    inbox = queue.Queue()
+    def receive():
+        for line in lines:
+            inbox.put(json.loads(line))
+        inbox.put(None)
+    threading.Thread(target=receive, daemon=True).start()
+
+    main.setupPyxel()
+    main.loadAtlas()
+    world = main.world
+    view = View(world, hello)
+    main.bakeLevel(world)
+    keys = main.PyxelInput()
+    held = [()]
+
+    def update():
+        while True:
+            try:
+                message = inbox.get_nowait()
+            except queue.Empty:
+                break
+            if message is None:
+                main.pyxel.quit()
+            view.apply(message)
+        if keys.btn("quit"):
+            main.pyxel.quit()
+        now = tuple(k for k in MOVE_KEYS if keys.btn(k))
+        if play and now != held[0]:
+            sock.sendall(encode({"type": "input", "keys": now}))
+            held[0] = now
+
+    main.pyxel.run(update, main.draw)
+
+# Connects count clients to a server for a few seconds. One of them reads
+#   every message to see how often ticks arrive and how late; the rest only
+#   count bytes, like a client that doesn't fall behind would. Every tenth
+#   client plays, wandering about at random.
+async def loadClients(host, port, count, seconds):
+    stats = {"bytes": 0, "dropped": 0, "ticks": 0, "lag": []}
+
+    async def client(i):
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            stats["dropped"] += 1
+            return
+        play = i % 10 == 1
+        writer.write(encode({"type": "join", "play": play}))
+        rng = random.Random(i)
+        end = time.time() + seconds
+        try:
+            while time.time() < end:
+                line = await asyncio.wait_for(reader.readline(), end - time.time())
+                if not line:
+                    stats["dropped"] += 1
+                    break
+                stats["bytes"] += len(line)
+                if i == 0:
+                    message = json.loads(line)
+                    if message["type"] == "tick":
+                        stats["ticks"] += 1
+                        stats["lag"].append(time.time() - message["sent"])
+                if play and rng.random() < 0.1:
+                    writer.write(encode({"type": "input", "keys": [rng.choice(MOVE_KEYS)]}))
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        writer.close()
+
+    await asyncio.gather(*(client(i) for i in range(count)))
+    lag = sorted(stats["lag"]) or [0]
+    return {
+        "clients": count,
+        "ticksPerSecond": stats["ticks"] / seconds,
+        "kbPerClientSecond": stats["bytes"] / count / seconds / 1024,
+        "lagMedianMs": lag[len(lag) // 2] * 1000,
+        "lagWorstMs": lag[-1] * 1000,
+        "dropped": stats["dropped"],
+    }
+
+# Starts a server in its own process on host:port and throws more and more
+#   clients at it. The server keeps up as long as ticks still arrive at about
+#   its fps.
+def loadTest(host, port, counts, seconds, serverArgs):
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--host", host, "--port", str(port)] + serverArgs)
+    try:
+        for attempt in range(100):
+            try:
+                socket.create_connection((host, port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        for count in counts:
+            r = asyncio.run(loadClients(host, port, count, seconds))
+            keepsUp = r["ticksPerSecond"] >= main.FPS * 0.95 and r["dropped"] == 0
+            print("{:5} clients {:6.1f} ticks/s {:7.1f} KiB/s each  lag {:6.1f}ms median {:7.1f}ms worst  {} dropped  {}".format(
+                r["clients"], r["ticksPerSecond"], r["kbPerClientSecond"], r["lagMedianMs"], r["lagWorstMs"], r["dropped"],
+                "ok" if keepsUp else "FALLING BEHIND"))
+    finally:
+        server.terminate()
+        server.wait()
+
+def intList(text):
+    return [int(x) for x in text.split(",")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves one smolgame world to many clients")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (or load test on), or to connect to with --connect")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--seed", type=int, help="seed for random")
+    parser.add_argument("--rooms", type=int, help="serve a worldgen level with this many rooms instead of the basic one")
+    parser.add_argument("--connect", metavar="HOST", help="join the server at HOST instead of running one")
+    parser.add_argument("--watch", action="store_true", help="with --connect, watch without playing")
+    parser.add_argument("--loadtest", type=intList, metavar="COUNTS", help="comma separated client counts to load test a server with")
+    parser.add_argument("--seconds", type=float, default=5, help="how long each load test step runs")
+    args = parser.parse_args()
+
+    if args.connect:
+        runClient(args.connect, args.port, not args.watch)
+    elif args.loadtest:
+        serverArgs = []
+        if args.seed is not None:
+            serverArgs += ["--seed", str(args.seed)]
+        if args.rooms is not None:
+            serverArgs += ["--rooms", str(args.rooms)]
+        loadTest(args.host, args.port, args.loadtest, args.seconds, serverArgs)
+    else:
+        worldFn = main.basicWorldgen
+        if args.rooms is not None:
+            worldFn = lambda world: main.worldgen(world, [0]*args.rooms)
+        game = GameServer(worldFn, args.seed)
+        print("Serving on {}:{}".format(args.host, args.port))
+        try:
+            asyncio.run(game.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
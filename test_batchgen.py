@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+
+# Tests for the level stats and validation in batchgen.py
+#
+#   python3 -m pytest -q test_batchgen.py
+
+import os, unittest
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import main, batchgen
+
+# A 3x3 room tile grid with floor squares for rooms at room tiles (1,1) and
+#   (2,1), around their middles
+WIDTH = HEIGHT = 3 * main.ROOM_TILES
+ROOMS = [(1, 1, "room", 0), (2, 1, "room", 0)]
+
+def level(join=False, wallOff=False):
+    tiles = bytearray(WIDTH * HEIGHT)
+    def put(x, y, tile):
+        tiles[x*HEIGHT + y] = tile
+    for roomX, roomY, kind, contents in ROOMS:
+        cX = roomX*main.ROOM_TILES + 7
+        cY = roomY*main.ROOM_TILES + 7
+        for x in range(cX - 2, cX + 3):
+            for y in range(cY - 2, cY + 3):
+                put(x, y, main.TILE_FLOOR)
+    if join:
+        for x in range(25, 35):
+            put(x, 22, main.TILE_FLOOR)
+    # A ring of wall around the second room
+    if wallOff:
+        for i in range(19, 26):
+            put(34, i, main.TILE_WALL)
+            put(40, i, main.TILE_WALL)
+            put(i + 15, 19, main.TILE_WALL)
+            put(i + 15, 25, main.TILE_WALL)
+    return tiles
+
+class TestLevelStats(unittest.TestCase):
+    TURRETS = [(37, 22, 1, "N")]
+
+    def stats(self, **kwargs):
+        return batchgen.levelStats(WIDTH, HEIGHT, level(**kwargs), ROOMS, self.TURRETS)
+
+    def testJoinedByFloor(self):
+        stats = self.stats(join=True)
+        self.assertTrue(stats["connected"])
+        self.assertTrue(stats["floorConnected"])
+        self.assertEqual(stats["turretsAlongFloors"], 1)
+        self.assertEqual(stats["floorArea"], 2*25 + 10)
+        self.assertEqual(stats["reachableFloor"], 2*25 + 10)
+        self.assertTrue(batchgen.isValid({"stats": stats}))
+
+    # The player can walk across the empty space, but not along floors
+    def testOnlyAcrossEmptySpace(self):
+        stats = self.stats()
+        self.assertTrue(stats["connected"])
+        self.assertFalse(stats["floorConnected"])
+        self.assertEqual(stats["turretsReached"], 1)
+        self.assertEqual(stats["turretsAlongFloors"], 0)
+        self.assertFalse(batchgen.isValid({"stats": stats}))
+
+    def testWalledOff(self):
+        stats = self.stats(wallOff=True)
+        self.assertFalse(stats["connected"])
+        self.assertEqual(stats["roomsReached"], 1)
+        self.assertEqual(stats["turretsReached"], 0)
+        self.assertEqual(stats["reachableFloor"], 25)
+
+    def testCoverage(self):
+        stats = self.stats(join=True)
+        self.assertGreater(stats["turretCoverage"], 0)
+        self.assertLess(stats["turretCoverage"], 1)
+        self.assertEqual(batchgen.levelStats(WIDTH, HEIGHT, level(join=True), ROOMS, [])["turretCoverage"], 0)
+
+class TestGenerateLevel(unittest.TestCase):
+    def testLevel(self):
+        level = batchgen.generateLevel(3, [1, 0, 0, 0, 0, 0])
+        self.assertEqual(level["stats"]["rooms"], 6)
+        self.assertEqual(len(level["turrets"]), 1)
+        self.assertEqual(len(batchgen.unpackGrid(level["tiles"])), level["width"] * level["height"])
+        world = main.World(headless=True)
+        main.worldgen(world, [1, 0, 0, 0, 0, 0], seed=3)
+        self.assertEqual(batchgen.unpackGrid(level["tiles"]), main.levelGrids(world)[2])
+
+    # Most small levels pass, the ones that don't have rooms outside the
+    #   play area
+    def testMostAreValid(self):
+        levels = [batchgen.generateLevel(seed, [1, 1, 0, 0, 0, 0], grids=False) for seed in range(20)]
+        self.assertGreater(sum(1 for level in levels if batchgen.isValid(level)), 10)
+        for level in levels:
+            if not batchgen.isValid(level):
+                self.assertTrue(any(x*main.ROOM_TILES + 7 >= main.GL_WIDTH or y*main.ROOM_TILES + 7 >= main.GL_HEIGHT
+                    for x, y, kind, contents in level["rooms"]))
+
+if __name__ == "__main__":
+    unittest.main()
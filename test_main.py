@@ -0,0 +1,624 @@
+#!/usr/bin/python3
+
+# Tests for the game logic in main.py. Everything here runs headless, no
+#   pyxel needed.
+#
+#   python3 -m pytest -q
+#   python3 -m unittest test_main
+
+import os, random, shutil, tempfile, tracemalloc, types, unittest
+
+# The room templates get loaded relative to where the game is run from
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import main
+
+# A wandering script for the player, a few ticks at a time in each direction
+def wanderScript(ticks, seed):
+    rng = random.Random(seed)
+    script = []
+    while len(script) < ticks:
+        script += [(rng.choice(["up", "down", "left", "right"]),)] * rng.randrange(1, 8)
+    return script[:ticks]
+
+# An empty headless world with walls at each of `walls`
+def wallWorld(walls=()):
+    world = main.World(headless=True)
+    for x, y in walls:
+        world.addStructure(main.Wall("wall", x, y, rng=world.rng))
+    return world
+
+# Bytes allocated per object made by make(), over n of them
+def bytesEach(make, n=2000):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = [make(i) for i in range(n)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(objs)
+
+class TestSlots(unittest.TestCase):
+    def testNoDict(self):
+        for tile in (main.Wall("wall", 0, 0), main.Floor("floor", 0, 0)):
+            self.assertFalse(hasattr(tile, "__dict__"))
+            with self.assertRaises(AttributeError):
+                tile.texName = ["player/ground.png"]
+
+    def testTexturesShared(self):
+        self.assertIs(main.Wall("wall", 0, 0).tex, main.Wall("wall", 1, 0).tex)
+        a = main.Floor("floor", 0, 0, texture="player/ground.png")
+        b = main.Floor("floor", 1, 0, texture="player/ground.png")
+        self.assertIs(a.tex, b.tex)
+
+    # The same tile with a __dict__ back, which is what every tile used to be
+    def testSmallerThanWithDict(self):
+        class DictWall(main.Wall):
+            pass
+        rng = random.Random(1)
+        slotted = bytesEach(lambda i: main.Wall("wall", i, 0, rng=rng))
+        withDict = bytesEach(lambda i: DictWall("wall", i, 0, rng=rng))
+        self.assertLess(slotted, withDict)
+
+class TestStructureMap(unittest.TestCase):
+    def setUp(self):
+        main.setupPyxel(False)
+
+    def testIndexedByTile(self):
+        world = wallWorld([(2, 3)])
+        wall = world.structureAt(2, 3)
+        self.assertIs(type(wall), main.Wall)
+        self.assertIsNone(world.structureAt(3, 2))
+        # The first one placed on a tile wins
+        world.addStructure(main.Floor("floor", 2, 3))
+        self.assertIs(world.structureAt(2, 3), wall)
+        world.removeStructure(wall)
+        self.assertIs(type(world.structureAt(2, 3)), main.Floor)
+
+    def testRemoveMany(self):
+        world = wallWorld([(x, 0) for x in range(10)])
+        world.removeStructures([world.structureAt(x, 0) for x in range(0, 10, 2)])
+        self.assertEqual([x for x in range(10) if world.structureAt(x, 0)], [1, 3, 5, 7, 9])
+        self.assertEqual(len(world.structures), 5)
+
+    def testCanGo(self):
+        world = wallWorld([(6, 5)])
+        world.addStructure(main.Floor("floor", 5, 6))
+        self.assertFalse(world.canGo(5, 5, 1, 0))
+        self.assertTrue(world.canGo(5, 5, 0, 1))
+        self.assertTrue(world.canGo(5, 5, -1, 0))
+        self.assertEqual(world.audio.played, 1)
+
+    def testCanGoDiagonal(self):
+        world = wallWorld([(6, 5)])
+        self.assertTrue(world.canGo(5, 5, 1, 1))
+        world.addStructure(main.Wall("wall", 5, 6))
+        self.assertFalse(world.canGo(5, 5, 1, 1))
+
+    def testCanGoEdges(self):
+        world = wallWorld()
+        self.assertFalse(world.canGo(0, 0, -1, 0))
+        self.assertFalse(world.canGo(0, main.GL_HEIGHT - 1, 0, 1))
+        world.bounded = False
+        self.assertTrue(world.canGo(0, 0, -1, 0))
+
+@unittest.skipIf(main.np is None, "numpy is not installed")
+class TestTileLevel(unittest.TestCase):
+    def testStamp(self):
+        np = main.np
+        level = main.TileLevel(4, 4)
+        template = np.full((3, 3), main.TILE_WALL, dtype=np.uint8)
+        template[1, 1] = main.TILE_EMPTY
+        level.tiles[1, 1] = main.TILE_FLOOR
+        # Hangs off the bottom right corner
+        level.stamp(template, 0, 0)
+        level.stamp(template, 2, 2)
+        self.assertEqual(level.tiles[1, 1], main.TILE_FLOOR)
+        self.assertEqual(level.tiles[3, 3], main.TILE_EMPTY)
+        self.assertEqual(level.tiles[2, 2], main.TILE_WALL)
+        self.assertEqual(level.tiles[0, 3], main.TILE_EMPTY)
+
+    def testAllowAt(self):
+        level = main.TileLevel(4, 4)
+        level.tiles[0, 0] = main.TILE_WALL
+        level.tiles[1, 0] = main.TILE_FLOOR_BLIP
+        self.assertEqual(level.allowAt(0, 0), False)
+        self.assertEqual(level.allowAt(1, 0), True)
+        self.assertIsNone(level.allowAt(2, 0))
+        self.assertIsNone(level.allowAt(-1, 0))
+        self.assertIsNone(level.allowAt(0, 4))
+
+    # Same seed, same walls and floors as the level built out of objects, as
+    #   far as an array level goes (GL_WIDTH x GL_HEIGHT)
+    def testSameLayoutAsObjects(self):
+        grids = []
+        for arrayLevel in (False, True):
+            world = main.World(headless=True)
+            main.worldgen(world, [0]*8, arrayLevel=arrayLevel, seed=2)
+            width, height, tiles, flips, phases = main.levelGrids(world)
+            kinds = {main.TILE_EMPTY: None, main.TILE_WALL: False, main.TILE_FLOOR: True, main.TILE_FLOOR_BLIP: True}
+            grids.append({(i // height, i % height): kinds[t] for i, t in enumerate(tiles)
+                if t != main.TILE_EMPTY and i // height < main.GL_WIDTH and i % height < main.GL_HEIGHT})
+        self.assertEqual(grids[0], grids[1])
+
+    def testCanGoReadsIt(self):
+        main.setupPyxel(False)
+        world = main.World(headless=True)
+        world.level = main.TileLevel(8, 8)
+        world.level.tiles[3, 2] = main.TILE_WALL
+        self.assertFalse(world.canGo(2, 2, 1, 0))
+        self.assertTrue(world.canGo(2, 2, 0, 1))
+
+class TestBeam(unittest.TestCase):
+    def testStopsShortOfWall(self):
+        world = wallWorld([(5, 0)])
+        beam = main.Beam(world, None, 0, 0, "W")
+        self.assertEqual(beam.segments, 9)
+        self.assertTrue(beam.hits(0, 0))
+        self.assertTrue(beam.hits(4, 0))
+        self.assertFalse(beam.hits(5, 0))
+        self.assertFalse(beam.hits(-1, 0))
+        self.assertFalse(beam.hits(2, 1))
+
+    def testVertical(self):
+        beam = main.Beam(wallWorld(), None, 3, 3, "N")
+        self.assertEqual(beam.segments, main.HEIGHT*4)
+        self.assertTrue(beam.hits(3, 0))
+        self.assertFalse(beam.hits(3, 4))
+
+class TestEntitiesNear(unittest.TestCase):
+    def setUp(self):
+        self.world = main.World(headless=True)
+        self.player = main.Player("player", 10, 10)
+        self.world.addEntity(self.player)
+        # Lots of turrets, so looking for them goes through the grid
+        self.turrets = [main.StationaryTurret("turret", x, y) for x in range(0, 40, 2) for y in range(0, 40, 2)]
+        for turret in self.turrets:
+            self.world.addEntity(turret)
+
+    # The same answer as checking every entity
+    def checkNear(self, x, y, radiusSq, kind=None):
+        expected = [e for e in self.world.entities if (kind is None or type(e) is kind) and (e.x - x)**2 + (e.y - y)**2 < radiusSq]
+        found = list(self.world.entitiesNear(x, y, radiusSq, kind))
+        self.assertEqual(sorted(map(id, found)), sorted(map(id, expected)))
+        return found
+
+    def testMatchesScan(self):
+        for x, y in ((10, 10), (0, 0), (39, 3), (-5, 20)):
+            for radiusSq in (1, 10, 40, 200):
+                self.checkNear(x, y, radiusSq)
+                self.checkNear(x, y, radiusSq, main.StationaryTurret)
+                self.checkNear(x, y, radiusSq, main.Player)
+
+    def testCutOffIsStrict(self):
+        self.assertEqual(self.checkNear(13, 10, 9, main.Player), [])
+        self.assertEqual(self.checkNear(13, 10, 10, main.Player), [self.player])
+
+    def testFollowsMoves(self):
+        self.world.moveEntity(self.player, 30, 30)
+        self.assertEqual(self.checkNear(10, 10, 4, main.Player), [])
+        self.assertEqual(self.checkNear(30, 31, 4, main.Player), [self.player])
+        turret = self.turrets[0]
+        self.world.moveEntity(turret, 31, 31)
+        self.assertIn(turret, self.checkNear(30, 30, 4))
+        self.world.removeEntity(turret)
+        self.assertNotIn(turret, self.checkNear(30, 30, 4))
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.oldProfiler = main.profiler
+        main.profiler = main.Profiler()
+
+    def tearDown(self):
+        main.profiler = self.oldProfiler
+
+    # F1 going down in the middle of a run turns the profiler on for that
+    #   tick, and the next press turns it off again
+    def testF1Toggles(self):
+        script = [(), ("profile",), ("profile",), (), ("profile",), ()]
+        sim = main.Simulation(inputs=main.ScriptedInput(script))
+        enabled = []
+        for tick in script:
+            sim.step()
+            enabled.append(main.profiler.enabled)
+        self.assertEqual(enabled, [False, True, True, True, False, False])
+        self.assertEqual(main.profiler.counts, {})
+
+    def testF1CountsWhileOn(self):
+        sim = main.Simulation(inputs=main.ScriptedInput([("profile",), (), ()]))
+        sim.step(3)
+        self.assertEqual(main.profiler.lastCounts.get("actorsTicked"), len(sim.world.scheduler))
+        self.assertIn("update", main.profiler.lastTimes)
+
+    def testAlwaysStaysOn(self):
+        main.profiler.always = True
+        main.profiler.enabled = True
+        sim = main.Simulation(inputs=main.ScriptedInput([("profile",), (), ("profile",)]))
+        sim.step(3)
+        self.assertTrue(main.profiler.enabled)
+        self.assertFalse(main.profiler.overlay)
+
+class TestChunkMap(unittest.TestCase):
+    def setUp(self):
+        self.world = main.World(headless=True)
+        self.player = main.Player("player", 7, 7)
+        self.world.addEntity(self.player)
+        main.endlessWorldgen(self.world, seed=9)
+        self.chunks = self.world.chunks
+
+    # (type, x, y, flip, phase) of every structure in the chunk at x,y
+    def chunkTiles(self, x, y):
+        return sorted((type(s).__name__, s.x, s.y, s.flip, getattr(s, "phase", 0)) for s in self.chunks.active[(x, y)])
+
+    def moveTo(self, x, y):
+        self.world.moveEntity(self.player, x, y)
+        self.chunks.stream()
+
+    def testLoadsAroundPlayer(self):
+        self.assertEqual(sorted(self.chunks.active), [(x, y) for x in (-1, 0, 1) for y in (-1, 0, 1)])
+        self.assertEqual(len(self.world.structures), sum(len(placed) for placed in self.chunks.active.values()))
+
+    def testUnloadsFarChunks(self):
+        # Two chunks away is still within CHUNK_KEEP_RADIUS, four isn't
+        self.moveTo(7 + 2*main.ROOM_TILES, 7)
+        self.assertIn((0, -1), self.chunks.active)
+        self.assertNotIn((-1, -1), self.chunks.active)
+        self.moveTo(7 + 4*main.ROOM_TILES, 7)
+        self.assertNotIn((0, -1), self.chunks.active)
+        self.assertTrue(all(s.x >= 2*main.ROOM_TILES for s in self.world.structures))
+        self.assertEqual(len(self.world.structures), sum(len(placed) for placed in self.chunks.active.values()))
+        self.assertIsNone(self.world.structureAt(7, 7))
+
+    def testRebuildsTheSame(self):
+        before = self.chunkTiles(0, 0)
+        self.moveTo(7 + 4*main.ROOM_TILES, 7)
+        self.moveTo(7, 7)
+        self.assertEqual(self.chunkTiles(0, 0), before)
+
+class TestLevelCache(unittest.TestCase):
+    ROOM_SETUP = [1, 2, 0, 0, 0, 0, 0, 0]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.oldDir = main.LEVEL_CACHE_DIR
+        main.LEVEL_CACHE_DIR = self.dir
+
+    def tearDown(self):
+        main.LEVEL_CACHE_DIR = self.oldDir
+        shutil.rmtree(self.dir)
+
+    def build(self, arrayLevel):
+        world = main.World(headless=True)
+        layout = main.worldgen(world, list(self.ROOM_SETUP), arrayLevel=arrayLevel, seed=5, cache=True)
+        turrets = [(type(e).__name__, e.x, e.y, e.dir) for e in world.entities]
+        return layout, main.levelGrids(world), turrets
+
+    def checkRoundTrip(self, arrayLevel):
+        layout, grids, turrets = self.build(arrayLevel)
+        self.assertIsNotNone(layout)
+        self.assertTrue(os.path.exists(main.levelCachePath(5, self.ROOM_SETUP, arrayLevel)))
+        layout, cachedGrids, cachedTurrets = self.build(arrayLevel)
+        # Loaded from the file this time
+        self.assertIsNone(layout)
+        self.assertEqual(cachedGrids, grids)
+        self.assertEqual(cachedTurrets, turrets)
+        self.assertEqual(len(turrets), 2)
+
+    def testObjectsRoundTrip(self):
+        self.checkRoundTrip(False)
+
+    @unittest.skipIf(main.np is None, "numpy is not installed")
+    def testArrayRoundTrip(self):
+        self.checkRoundTrip(True)
+
+    def testOtherVersionIsNotLoaded(self):
+        self.build(False)
+        path = main.levelCachePath(5, self.ROOM_SETUP, False)
+        old = main.LEVEL_CACHE_VERSION
+        main.LEVEL_CACHE_VERSION = old + 1
+        try:
+            self.assertFalse(main.loadLevelCache(main.World(headless=True), path, False))
+        finally:
+            main.LEVEL_CACHE_VERSION = old
+        self.assertTrue(main.loadLevelCache(main.World(headless=True), path, False))
+
+    # What goes in the rooms is rolled after the level, so it doesn't change it
+    def testContentsDontChangeLevel(self):
+        grids = []
+        for roomSetup in ([0]*8, list(self.ROOM_SETUP)):
+            world = main.World(headless=True)
+            main.worldgen(world, roomSetup, seed=5)
+            grids.append(main.levelGrids(world))
+        self.assertEqual(grids[0], grids[1])
+
+    def testTruncatedFileIsNotLoaded(self):
+        self.build(False)
+        path = main.levelCachePath(5, self.ROOM_SETUP, False)
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 1)
+        self.assertFalse(main.loadLevelCache(main.World(headless=True), path, False))
+
+class TestRoomLayout(unittest.TestCase):
+    # Big layouts used to walk into the top rows and never get out
+    def testBigLayoutsFinish(self):
+        for seed in range(20):
+            layout = main.roomLayout([0]*40, random.Random(seed))
+            self.assertEqual(sum(1 for room in layout.values() if type(room) is main.Room), 40)
+            self.assertTrue(all(0 <= x < 15 and 0 <= y < 9 for x, y in layout))
+
+class TestRoomTemplates(unittest.TestCase):
+    # Door and edge cells of a room on each side: up, down, left, right
+    SIDES = (((7, 2), (7, 0)), ((7, 12), (7, 14)), ((2, 7), (0, 7)), ((12, 7), (14, 7)))
+
+    def testDoorsFaceTheirNeighbours(self):
+        for side, (door, edge) in enumerate(self.SIDES):
+            for csvFile in (main.Room.csvFile, main.Hallway.csvFile):
+                joins = [i == side for i in range(4)]
+                roomData = main.roomVariant(csvFile, *joins)[0]
+                self.assertIs(roomData[door[0]][door[1]], main.Floor, (csvFile, side))
+                self.assertIs(roomData[edge[0]][edge[1]], main.Floor, (csvFile, side))
+                for other, (otherDoor, otherEdge) in enumerate(self.SIDES):
+                    if other != side:
+                        self.assertIsNone(roomData[otherEdge[0]][otherEdge[1]], (csvFile, side, other))
+
+class TestSimulation(unittest.TestCase):
+    # Worlds share nothing that changes what happens in them, so running two
+    #   a tick at a time each comes out the same as running one on its own
+    def testInterleavedWorldsAreIndependent(self):
+        script = wanderScript(400, 8)
+        alone = main.Simulation(worldFn=main.endlessWorldgen, inputs=main.ScriptedInput(script), seed=4)
+        alone.step(400)
+        a = main.Simulation(worldFn=main.endlessWorldgen, inputs=main.ScriptedInput(script), seed=4)
+        b = main.Simulation(worldFn=main.endlessWorldgen, inputs=main.ScriptedInput(wanderScript(400, 9)), seed=5)
+        for tick in range(400):
+            a.step()
+            b.step()
+        self.assertEqual(a.world.stateHash(), alone.world.stateHash())
+        self.assertNotEqual(b.world.stateHash(), alone.world.stateHash())
+
+    def testLeavesModuleStateAlone(self):
+        state = random.getstate()
+        shown = main.world
+        sim = main.Simulation(worldFn=main.endlessWorldgen, inputs=main.ScriptedInput(wanderScript(100, 1)), seed=2)
+        sim.step(100)
+        self.assertEqual(random.getstate(), state)
+        self.assertIs(main.world, shown)
+        self.assertFalse(main.windowOpen)
+        self.assertIsInstance(sim.world.audio, main.NullAudio)
+
+    def testQuitStops(self):
+        sim = main.Simulation(inputs=main.ScriptedInput([(), (), ("quit",)]))
+        self.assertEqual(sim.step(10), 3)
+        self.assertTrue(sim.world.quitRequested)
+
+class TestFlowField(unittest.TestCase):
+    def testDistances(self):
+        world = wallWorld()
+        world.addEntity(main.Player("player", 5, 5))
+        self.assertEqual(world.flow.distanceFrom(8, 5), 3)
+        self.assertEqual(world.flow.stepFrom(8, 5), (-1, 0))
+        self.assertIsNone(world.flow.stepFrom(5, 5))
+
+    def testGoesAroundWalls(self):
+        world = wallWorld()
+        world.addEntity(main.Player("player", 5, 5))
+        self.assertEqual(world.flow.distanceFrom(7, 5), 2)
+        world.tick += 1
+        for y in (4, 5, 6):
+            world.addStructure(main.Wall("wall", 6, y))
+        self.assertEqual(world.flow.distanceFrom(7, 5), 6)
+        self.assertIsNone(world.flow.distanceFrom(6, 5))
+
+class TestChase(unittest.TestCase):
+    def setUp(self):
+        main.setupPyxel(False)
+
+    def turret(self, world):
+        return world.entitiesOfType(main.MovingTurret)[0]
+
+    # The moving turret in the basic world comes after the player, however
+    #   they go, and stops next to them
+    def testBasicWorldTurretChases(self):
+        script = [("left",)]*12 + [("up",)]*6 + [()]*80
+        sim = main.Simulation(inputs=main.ScriptedInput(script), seed=1)
+        turret = self.turret(sim.world)
+        self.assertTrue(turret.chase)
+        sim.step(len(script))
+        player = sim.world.entitiesOfType(main.Player)[0]
+        self.assertEqual(sim.world.flow.distanceFrom(turret.x, turret.y), 1)
+        self.assertEqual(abs(turret.x - player.x) + abs(turret.y - player.y), 1)
+        self.assertEqual(main.DIR_STEP[turret.dir], (player.x - turret.x, player.y - turret.y))
+
+    def testPlacedTurretsChase(self):
+        world = main.World(headless=True)
+        main.worldgen(world, [2, 0, 0, 0], seed=1)
+        turret = self.turret(world)
+        self.assertTrue(turret.chase)
+        world.addEntity(main.Player("player", turret.x + 3, turret.y))
+        for tick in range(20):
+            world.update()
+        self.assertEqual(world.flow.distanceFrom(turret.x, turret.y), 1)
+
+# Something for a Scheduler to tick, which writes its name down in log
+class Ticked():
+    tickable = True
+
+    def __init__(self, name, log):
+        self.name = name
+        self.log = log
+
+    def update(self, world):
+        self.log.append(self.name)
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+        self.scheduler = main.Scheduler()
+        self.actors = [Ticked(i, self.log) for i in range(4)]
+        for actor in self.actors:
+            self.scheduler.add(actor)
+
+    def tick(self, tick):
+        del self.log[:]
+        self.scheduler.run(None, tick)
+        return list(self.log)
+
+    def testRunsInOrderAdded(self):
+        self.assertEqual(self.tick(1), [0, 1, 2, 3])
+
+    def testEvery(self):
+        self.scheduler.setEvery(self.actors[2], 3)
+        ran = [2 in self.tick(tick) for tick in range(1, 10)]
+        self.assertEqual(ran, [True, False, False, True, False, False, True, False, False])
+
+    def testShorterEveryTakesEffectStraightAway(self):
+        self.scheduler.setEvery(self.actors[0], 10)
+        self.tick(1)
+        self.scheduler.setEvery(self.actors[0], 1)
+        self.assertIn(0, self.tick(2))
+
+    def testSleepAndWakeKeepOrder(self):
+        self.scheduler.sleep(self.actors[0])
+        self.scheduler.sleep(self.actors[2])
+        self.assertEqual(self.tick(1), [1, 3])
+        self.assertEqual(len(self.scheduler), 2)
+        self.scheduler.wake(self.actors[2])
+        self.scheduler.wake(self.actors[0])
+        self.assertEqual(self.tick(2), [0, 1, 2, 3])
+
+    def testRemoveDuringTick(self):
+        log = self.log
+        scheduler = self.scheduler
+        class Remover(Ticked):
+            def update(self, world):
+                log.append(self.name)
+                scheduler.remove(self.victim)
+        remover = Remover("r", log)
+        remover.victim = self.actors[0]
+        scheduler.remove(self.actors[0])
+        scheduler.add(remover)
+        scheduler.add(self.actors[0])
+        self.assertEqual(self.tick(1), [1, 2, 3, "r"])
+
+    def testAddedDuringTickWaits(self):
+        log = self.log
+        scheduler = self.scheduler
+        late = Ticked("late", log)
+        class Adder(Ticked):
+            def update(self, world):
+                log.append(self.name)
+                scheduler.add(late)
+        scheduler.add(Adder("a", log))
+        self.assertEqual(self.tick(1), [0, 1, 2, 3, "a"])
+        self.assertEqual(self.tick(2), [0, 1, 2, 3, "a", "late"])
+
+    # A turret with nobody near sleeps, and wakes up to arm when a player
+    #   walks up to it
+    def testIdleTurretSleeps(self):
+        main.setupPyxel(False)
+        world = main.World(headless=True)
+        turret = main.StationaryTurret("turret", 20, 20, "N", rng=world.rng)
+        player = main.Player("player", 40, 20, input=main.ScriptedInput([]))
+        world.addEntity(turret)
+        world.addEntity(player)
+        world.scheduler.run(world, 1)
+        self.assertEqual(len(world.scheduler), 1)
+        for tick, x in enumerate(range(30, 21, -1), 2):
+            world.moveEntity(player, x, 20)
+            world.scheduler.run(world, tick)
+        self.assertEqual(len(world.scheduler), 2)
+        self.assertGreater(turret.charge, 0)
+
+    def testOnlyTickables(self):
+        scheduler = main.Scheduler()
+        scheduler.add(main.Wall("wall", 0, 0))
+        self.assertEqual(len(scheduler), 0)
+
+class TestVisibility(unittest.TestCase):
+    def testWallsBlockSight(self):
+        world = wallWorld([(3, 5)])
+        self.assertTrue(world.sight.canSee(0, 5, 2, 5, 8))
+        self.assertTrue(world.sight.canSee(0, 5, 3, 5, 8))
+        self.assertFalse(world.sight.canSee(0, 5, 5, 5, 8))
+        self.assertFalse(world.sight.canSee(0, 5, 9, 5, 8))
+
+    def testRemovedWallIsSeenPast(self):
+        world = wallWorld([(3, 5)])
+        self.assertFalse(world.sight.canSee(0, 5, 5, 5, 8))
+        world.removeStructure(world.structureAt(3, 5))
+        self.assertTrue(world.sight.canSee(0, 5, 5, 5, 8))
+
+class TestReplay(unittest.TestCase):
+    TICKS = 300
+
+    def record(self, worldName):
+        rec = main.RecordingInput(main.ScriptedInput(wanderScript(self.TICKS, 3)), 11, worldName)
+        sim = main.Simulation(worldFn=main.WORLD_FNS[worldName], inputs=rec, seed=11)
+        sim.step(self.TICKS)
+        return rec
+
+    def play(self, inputs):
+        sim = main.Simulation(worldFn=main.WORLD_FNS[inputs.worldName], inputs=inputs, seed=inputs.seed)
+        sim.step(len(inputs.masks))
+        return inputs
+
+    def testReplaysMatch(self):
+        fd, filename = tempfile.mkstemp(suffix=".rep")
+        os.close(fd)
+        try:
+            for worldName in ("basic", "endless"):
+                self.record(worldName).save(filename)
+                inputs = self.play(main.loadReplay(filename))
+                self.assertIsNone(inputs.diverged, worldName)
+                self.assertEqual(inputs.checked, self.TICKS)
+        finally:
+            os.remove(filename)
+
+    def testTamperedReplayDiverges(self):
+        rec = self.record("basic")
+        hashes = list(rec.hashes)
+        hashes[100] ^= 1
+        inputs = self.play(main.ReplayInput(rec.seed, rec.worldName, bytes(rec.masks), hashes))
+        self.assertEqual(inputs.diverged, 101)
+
+    def testBadFileIsNotLoaded(self):
+        fd, filename = tempfile.mkstemp(suffix=".rep")
+        os.write(fd, b"SMRP not a recording")
+        os.close(fd)
+        try:
+            self.assertIsNone(main.loadReplay(filename))
+        finally:
+            os.remove(filename)
+
+class TestQueuedAudio(unittest.TestCase):
+    def setUp(self):
+        self.played = []
+        backend = types.SimpleNamespace(play=lambda stream, sound: self.played.append((stream, sound.name)))
+        self.audio = main.QueuedAudio(backend)
+        self.buzz = types.SimpleNamespace(name="buzz", priority=0, ticks=3)
+        self.bump = types.SimpleNamespace(name="bump", priority=0, ticks=1)
+        self.level = types.SimpleNamespace(name="level", priority=1, ticks=5)
+
+    def tick(self, *posted):
+        del self.played[:]
+        for stream, sound in posted:
+            self.audio.play(stream, sound)
+        self.audio.flush()
+        return list(self.played)
+
+    def testOncePerTick(self):
+        self.assertEqual(self.tick((0, self.buzz), (0, self.buzz), (0, self.buzz)), [(0, "buzz")])
+
+    def testNotRestartedWhilePlaying(self):
+        self.assertEqual(self.tick((0, self.buzz)), [(0, "buzz")])
+        self.assertEqual(self.tick((0, self.buzz)), [])
+        self.assertEqual(self.tick((0, self.buzz)), [])
+        self.assertEqual(self.tick((0, self.buzz)), [(0, "buzz")])
+
+    def testPriority(self):
+        self.assertEqual(self.tick((0, self.buzz), (0, self.level), (1, self.bump)), [(0, "level"), (1, "bump")])
+        # level is still playing, and nothing posted beats it
+        self.assertEqual(self.tick((0, self.buzz)), [])
+        self.assertEqual(self.tick((0, self.bump)), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+# Tests for what server.py sends its clients
+#
+#   python3 -m pytest -q test_server.py
+
+import os, json, asyncio, unittest
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import main, server
+
+class TestGameServer(unittest.TestCase):
+    def setUp(self):
+        self.game = server.GameServer(seed=1)
+
+    # Nobody is playing until a client joins to play
+    def testNoPlayersBeforeJoining(self):
+        self.assertEqual(list(self.game.world.entitiesOfType(main.Player)), [])
+        kinds = [state[0] for state in self.game.snapshot()["entities"].values()]
+        self.assertNotIn("player", kinds)
+        self.assertIn("moving", kinds)
+
+    def testOnlyChangesSent(self):
+        self.assertEqual(self.game.delta()["entities"], {})
+        turret = main.StationaryTurret("turret", 3, 4, "S")
+        self.game.world.addEntity(turret)
+        entities = self.game.delta()["entities"]
+        self.assertEqual(list(entities.values()), [["turret", 3, 4, "S", 0]])
+
+    def testGone(self):
+        turret = main.StationaryTurret("turret", 3, 4, "S")
+        self.game.world.addEntity(turret)
+        self.game.delta()
+        id = self.game.ids[turret]
+        self.game.world.removeEntity(turret)
+        message = self.game.delta()
+        self.assertEqual(message["gone"], [id])
+        self.assertNotIn(turret, self.game.ids)
+        self.assertNotIn(id, self.game.sent)
+        self.assertNotIn("gone", self.game.delta())
+
+    # A player that leaves before any tick goes out never shows up in
+    #   delta(), but still shouldn't keep its id
+    def testLeavingBeforeATick(self):
+        game = self.game
+        async def joinAndLeave():
+            listener = await asyncio.start_server(game.handle, "127.0.0.1", 0)
+            port = listener.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(server.encode({"type": "join", "play": True}))
+            hello = json.loads(await reader.readline())
+            players = list(game.world.entitiesOfType(main.Player))
+            writer.close()
+            for attempt in range(100):
+                if not game.clients:
+                    break
+                await asyncio.sleep(0.01)
+            listener.close()
+            await listener.wait_closed()
+            return hello, players
+        hello, players = asyncio.run(joinAndLeave())
+        self.assertEqual(len(players), 1)
+        self.assertIsNotNone(hello["you"])
+        self.assertEqual(list(game.world.entitiesOfType(main.Player)), [])
+        self.assertNotIn(players[0], game.ids)
+        self.assertNotIn(hello["you"], game.ids.values())
+
+if __name__ == "__main__":
+    unittest.main()